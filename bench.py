@@ -0,0 +1,299 @@
+"""Offline load test for the chat service.
+
+Starts main.py in a subprocess against local stand-ins for the Assistants API
+and the Salebot callback endpoint (see bench_mocks.py), replays a JSONL traffic
+file at a target rate and reports throughput, POST-to-callback latency and the
+app's event-loop lag. No network access is needed.
+
+    python bench.py --traffic requests.jsonl --rate 20 --count 200
+    python bench.py --save-baseline baseline.json
+    python bench.py --baseline baseline.json
+    python bench.py --workers 4   # through cluster.py
+
+Each traffic line is a ChatRequest as JSON; missing fields are filled in. The
+callback_text of every request is replaced with a unique id to match callbacks.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import uvicorn
+
+from bench_mocks import create_callback_mock, create_openai_mock
+
+APP_LOG = "bench_output.txt"
+# Gauges that are non-zero while the app still has work for already accepted requests
+BUSY_METRICS = ("job_queue_depth", "job_workers_busy", "thread_scheduler_active_threads", "callbacks_in_flight")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_traffic(path: str, count: int, threads: int) -> list:
+    lines = []
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            lines = [json.loads(line) for line in file if line.strip()]
+    if not lines:
+        lines = [{}]
+
+    traffic = []
+    for i in range(count):
+        line = lines[i % len(lines)]
+        traffic.append({
+            "thread_id": line.get("thread_id") or f"thread_bench_{i % threads}",
+            "asst_id": line.get("asst_id") or "asst_bench",
+            "api_key": line.get("api_key") or "bench",
+            # A thread belongs to one client, so messages on it can be coalesced
+            "client_id": line.get("client_id") or i % threads,
+            "message": line.get("message") or f"Benchmark message {i}",
+            "callback_text": f"bench-{i}",
+        })
+    return traffic
+
+
+def metric_value(metrics_text: str, name: str) -> float:
+    # Texts of several workers may be concatenated, their samples are summed
+    return sum(float(line.split(" ", 1)[1]) for line in metrics_text.splitlines() if line.startswith(f"{name} "))
+
+
+def answered_latencies(traffic: list, accepted: set, sent_at: dict, callbacks: dict) -> dict:
+    """Latency of every accepted request, including those coalesced into a later request's run.
+
+    A coalesced reply goes to the callback of the last request in the batch. Runs on a thread
+    follow arrival order, so a request is answered by the callback of the first request at or
+    after it on its thread that shares its batch (same assistant, api_key and client_id).
+    """
+    batches = {}
+    for request in traffic:
+        if request["callback_text"] in accepted:
+            batch = (request["thread_id"], request["asst_id"], request["api_key"], request["client_id"])
+            batches.setdefault(batch, []).append(request["callback_text"])
+
+    latencies = {}
+    for keys in batches.values():
+        keys.sort(key=sent_at.get)
+        answered_at = None
+        for key in reversed(keys):
+            if key in callbacks:
+                answered_at = callbacks[key][0]
+            if answered_at is not None:
+                latencies[key] = answered_at - sent_at[key]
+    return latencies
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * q
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def histogram_quantile(metrics_text: str, name: str, q: float):
+    # Same estimate as Prometheus' histogram_quantile: linear interpolation inside the bucket
+    counts = {}
+    for line in metrics_text.splitlines():
+        if line.startswith(f"{name}_bucket{{"):
+            labels, value = line.rsplit(" ", 1)
+            bound = labels.split('le="', 1)[1].split('"', 1)[0]
+            bound = float("inf") if bound == "+Inf" else float(bound)
+            counts[bound] = counts.get(bound, 0) + float(value)
+    buckets = sorted(counts.items())
+    if not buckets or buckets[-1][1] == 0:
+        return None
+
+    rank = q * buckets[-1][1]
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+async def start_server(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as http:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"App exited with code {process.returncode}, see {APP_LOG}")
+            try:
+                if (await http.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"App did not start within {timeout}s, see {APP_LOG}")
+
+
+async def run_benchmark(args) -> dict:
+    callbacks = {}
+
+    def on_callback(payload: dict, received_at: float):
+        callbacks[payload.get("message")] = (received_at, payload.get("open_ai_status"))
+
+    openai_mock = create_openai_mock(
+        run_duration=args.run_duration,
+        run_jitter=args.run_jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        rpm=args.mock_rpm,
+    )
+    openai_port, callback_port, app_port = free_port(), free_port(), free_port()
+    servers = [
+        await start_server(openai_mock, openai_port),
+        await start_server(create_callback_mock(on_callback, latency=args.callback_latency), callback_port),
+    ]
+
+    env = {
+        **os.environ,
+        "GPT_TOKEN": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "CALLBACK_BASE_URL": f"http://127.0.0.1:{callback_port}",
+        **dict(setting.split("=", 1) for setting in args.env),
+    }
+    if args.workers > 1:
+        command = [sys.executable, "cluster.py", "--workers", str(args.workers), "--port", str(app_port), "--worker-base-port", str(free_port())]
+        metrics_paths = [f"/metrics/{index}" for index in range(args.workers)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port)]
+        metrics_paths = ["/metrics"]
+    app_url = f"http://127.0.0.1:{app_port}"
+    with open(APP_LOG, "w") as log:
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        for path in metrics_paths:
+            await wait_until_up(f"{app_url}{path}", process)
+        traffic = load_traffic(args.traffic, args.count, args.threads)
+        sent_at = {}
+        statuses = {}
+
+        async with httpx.AsyncClient(base_url=app_url, timeout=30, limits=httpx.Limits(max_connections=200)) as http:
+            async def post(request: dict, at: float):
+                await asyncio.sleep(max(at - time.time(), 0))
+                sent_at[request["callback_text"]] = time.time()
+                try:
+                    response = await http.post("/", json=request)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                statuses[status] = statuses.get(status, 0) + 1
+                return request["callback_text"], status
+
+            start_time = time.time()
+            results = await asyncio.gather(*(post(request, start_time + i / args.rate) for i, request in enumerate(traffic)))
+            accepted = {key for key, status in results if status == 200}
+
+            # Requests coalesced into a later run share its callback, so wait for the app to go idle
+            # rather than for a callback per request
+            deadline = time.time() + args.drain_timeout
+            while True:
+                metrics_text = "".join([(await http.get(path)).text for path in metrics_paths])
+                if not any(metric_value(metrics_text, name) for name in BUSY_METRICS) or time.time() > deadline:
+                    break
+                await asyncio.sleep(0.2)
+
+        latencies = list(answered_latencies(traffic, accepted, sent_at, callbacks).values())
+        answered = [key for key in accepted if key in callbacks]
+        finished_at = max((callbacks[key][0] for key in answered), default=time.time())
+        return {
+            "sent": len(traffic),
+            "offered_rate": args.rate,
+            "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            "callbacks": len(answered),
+            "callback_errors": sum(1 for key in answered if callbacks[key][1] != "ok"),
+            # Coalesced requests are answered by the callback of a later request on the same thread
+            "coalesced": int(metric_value(metrics_text, "thread_scheduler_coalesced_total")),
+            "unanswered": len(accepted) - len(latencies),
+            "throughput": len(latencies) / max(finished_at - start_time, 1e-9),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_p99": percentile(latencies, 0.99),
+            "loop_lag_p50": histogram_quantile(metrics_text, "event_loop_lag_seconds", 0.5),
+            "loop_lag_p99": histogram_quantile(metrics_text, "event_loop_lag_seconds", 0.99),
+            "openai_calls": dict(openai_mock.state.stats),
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=args.drain_timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        for server in servers:
+            server.should_exit = True
+        await asyncio.sleep(0.1)
+
+
+def format_value(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def print_report(result: dict, baseline: dict = None) -> None:
+    for key, value in result.items():
+        line = f"{key:>16}: {format_value(value)}"
+        previous = (baseline or {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(previous, (int, float)) and previous:
+            line += f"  (baseline {format_value(previous)}, {(value - previous) / previous * 100:+.1f}%)"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--traffic", default="requests.jsonl", help="JSONL file of ChatRequest bodies to replay")
+    parser.add_argument("--count", type=int, default=100, help="Number of requests to send")
+    parser.add_argument("--rate", type=float, default=10, help="Requests per second to offer")
+    parser.add_argument("--threads", type=int, default=50, help="Distinct thread ids for lines without one")
+    parser.add_argument("--run-duration", type=float, default=1.0, help="Seconds a mock run takes")
+    parser.add_argument("--run-jitter", type=float, default=0.2, help="Random +/- seconds added to each run")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of runs.create calls failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of runs.create calls failing with 429")
+    parser.add_argument("--mock-rpm", type=int, default=10000, help="Requests per minute the mock API allows")
+    parser.add_argument("--callback-latency", type=float, default=0.05, help="Seconds the mock callback takes to answer")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for outstanding callbacks")
+    parser.add_argument("--workers", type=int, default=1, help="Run the app as a cluster of this many workers")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra environment for the app, e.g. JOB_WORKERS=16")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--save-baseline", help="Write the report as JSON to this path")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            json.dump(result, file, indent=2)
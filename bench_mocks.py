@@ -0,0 +1,158 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import deque
+from typing import Callable
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_openai_mock(
+    run_duration: float = 1.0,
+    run_jitter: float = 0.2,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    rpm: int = 500,
+    tpm: int = 200000,
+) -> FastAPI:
+    """Stand-in for the Assistants API endpoints used by main.py.
+
+    Runs complete ``run_duration`` (+/- ``run_jitter``) seconds after they are
+    created. ``error_rate`` and ``rate_limit_rate`` are the shares of
+    runs.create calls answered with a 500 or a 429. Like the real API, a thread
+    accepts only one active run at a time.
+    """
+    app = FastAPI()
+    ids = itertools.count(1)
+    runs = {}
+    active_runs = {}
+    recent_creates = deque()
+    app.state.stats = {"threads_retrieve": 0, "runs_create": 0, "runs_retrieve": 0, "messages_list": 0, "errors": 0, "rate_limited": 0, "conflicts": 0}
+    stats = app.state.stats
+
+    def run_object(run: dict) -> dict:
+        done = time.time() >= run["completes_at"]
+        return {
+            "id": run["id"],
+            "object": "thread.run",
+            "created_at": int(run["created_at"]),
+            "assistant_id": run["assistant_id"],
+            "thread_id": run["thread_id"],
+            "status": "completed" if done else "in_progress",
+            "instructions": "",
+            "tools": [],
+            "model": run["model"],
+            "parallel_tool_calls": True,
+            "usage": run["usage"] if done else None,
+        }
+
+    def message_object(run: dict) -> dict:
+        return {
+            "id": f"msg_{run['id']}",
+            "object": "thread.message",
+            "created_at": int(run["completes_at"]),
+            "thread_id": run["thread_id"],
+            "run_id": run["id"],
+            "role": "assistant",
+            "status": "completed",
+            "attachments": [],
+            "metadata": {},
+            "content": [{"type": "text", "text": {"value": run["reply"], "annotations": []}}],
+        }
+
+    def rate_limit_headers() -> dict:
+        now = time.time()
+        while recent_creates and recent_creates[0] < now - 60:
+            recent_creates.popleft()
+        return {
+            "x-ratelimit-limit-requests": str(rpm),
+            "x-ratelimit-remaining-requests": str(max(rpm - len(recent_creates), 0)),
+            "x-ratelimit-limit-tokens": str(tpm),
+            "x-ratelimit-remaining-tokens": str(tpm),
+        }
+
+    def error(status: int, message: str, headers: dict = None) -> JSONResponse:
+        return JSONResponse({"error": {"message": message, "type": "mock_error", "code": None}}, status_code=status, headers=headers)
+
+    @app.get("/v1/threads/{thread_id}")
+    async def retrieve_thread(thread_id: str):
+        stats["threads_retrieve"] += 1
+        return {"id": thread_id, "object": "thread", "created_at": 0, "metadata": {}, "tool_resources": None}
+
+    @app.post("/v1/threads/{thread_id}/runs")
+    async def create_run(thread_id: str, request: Request):
+        stats["runs_create"] += 1
+        body = await request.json()
+        headers = rate_limit_headers()
+
+        if random.random() < rate_limit_rate or headers["x-ratelimit-remaining-requests"] == "0":
+            stats["rate_limited"] += 1
+            return error(429, "Rate limit reached", {**headers, "retry-after": "1"})
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return error(500, "The server had an error while processing your request")
+        active = active_runs.get(thread_id)
+        if active and time.time() < runs[active]["completes_at"]:
+            stats["conflicts"] += 1
+            return error(400, f"Thread {thread_id} already has an active run {active}.")
+
+        recent_creates.append(time.time())
+        messages = [message["content"] for message in body.get("additional_messages") or []]
+        created_at = time.time()
+        run = {
+            "id": f"run_{next(ids)}",
+            "thread_id": thread_id,
+            "assistant_id": body["assistant_id"],
+            "model": body.get("model", "gpt-4o-mini"),
+            "created_at": created_at,
+            "completes_at": created_at + max(run_duration + random.uniform(-run_jitter, run_jitter), 0),
+            "reply": f"Reply to: {' / '.join(messages)}",
+            "usage": {"prompt_tokens": 500, "completion_tokens": 50, "total_tokens": 550},
+        }
+        runs[run["id"]] = run
+        active_runs[thread_id] = run["id"]
+
+        if not body.get("stream"):
+            return JSONResponse(run_object(run), headers=headers)
+
+        async def events():
+            yield f"event: thread.run.created\ndata: {json.dumps(run_object(run))}\n\n"
+            await asyncio.sleep(max(run["completes_at"] - time.time(), 0))
+            yield f"event: thread.message.completed\ndata: {json.dumps(message_object(run))}\n\n"
+            yield f"event: thread.run.completed\ndata: {json.dumps(run_object(run))}\n\n"
+            yield "event: done\ndata: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    @app.get("/v1/threads/{thread_id}/runs/{run_id}")
+    async def retrieve_run(thread_id: str, run_id: str):
+        stats["runs_retrieve"] += 1
+        if run_id not in runs:
+            return error(404, f"No run found with id '{run_id}'.")
+        return run_object(runs[run_id])
+
+    @app.get("/v1/threads/{thread_id}/messages")
+    async def list_messages(thread_id: str, run_id: str = None):
+        stats["messages_list"] += 1
+        run = runs.get(run_id or active_runs.get(thread_id))
+        data = [message_object(run)] if run else []
+        return {"object": "list", "data": data, "first_id": None, "last_id": None, "has_more": False}
+
+    return app
+
+
+def create_callback_mock(on_callback: Callable[[dict, float], None], latency: float = 0.05) -> FastAPI:
+    """Stand-in for the Salebot callback endpoint that answers after ``latency`` seconds."""
+    app = FastAPI()
+
+    @app.post("/api/{api_key}/callback")
+    async def callback(api_key: str, request: Request):
+        payload = await request.json()
+        on_callback(payload, time.time())
+        await asyncio.sleep(latency)
+        return {"status": "ok"}
+
+    return app
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: the endpoint is overloaded or temporarily down
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+@dataclass
+class DeliveryResult:
+    url: str
+    outcome: str  # "ok", "fallback" (error callback delivered instead) or "failed"
+    attempts: int
+    latency: float
+    error: Optional[str] = None
+
+
+class CallbackDelivery:
+    """Delivers callbacks in the background over pooled keep-alive connections.
+
+    One httpx.AsyncClient is kept per callback host, concurrency is capped by a
+    semaphore and failed deliveries are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 20,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+        timeout: float = 60.0,
+        max_keepalive: int = 10,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        on_result: Optional[Callable[[DeliveryResult], None]] = None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.max_keepalive = max_keepalive
+        self.transport = transport
+        self.on_result = on_result
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {"ok": 0, "fallback": 0, "failed": 0, "attempts": 0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def _client_for(self, url: str) -> httpx.AsyncClient:
+        parts = urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}"
+        client = self._clients.get(key)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                transport=self.transport,
+                limits=httpx.Limits(
+                    max_connections=self.max_keepalive * 2,
+                    max_keepalive_connections=self.max_keepalive,
+                ),
+            )
+            self._clients[key] = client
+        return client
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter keeps retries from many deliveries from lining up
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def submit(
+        self,
+        url: str,
+        payload: dict,
+        headers: dict,
+        fallback: Optional[Callable[[str], dict]] = None,
+    ) -> asyncio.Task:
+        """Schedules a delivery and returns immediately.
+
+        If every attempt fails, ``fallback(error)`` builds a payload that is sent once instead.
+        """
+        task = asyncio.create_task(self._deliver(url, payload, headers, fallback))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _post(self, url: str, payload: dict, headers: dict) -> None:
+        self.stats["attempts"] += 1
+        async with self._semaphore:
+            response = await self._client_for(url).post(url, json=payload, headers=headers)
+        response.raise_for_status()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in RETRYABLE_STATUSES
+        return isinstance(error, httpx.TransportError)
+
+    async def _deliver(self, url, payload, headers, fallback) -> DeliveryResult:
+        start_time = time.perf_counter()
+        attempt = 0
+        error = None
+
+        while attempt < self.max_attempts:
+            attempt += 1
+            try:
+                await self._post(url, payload, headers)
+                return self._finish(DeliveryResult(url, "ok", attempt, time.perf_counter() - start_time))
+            except Exception as e:
+                # Errors outside httpx.HTTPError (e.g. a malformed URL or header) fail the same way every time
+                error = e
+                if not self._is_retryable(e) or attempt >= self.max_attempts:
+                    break
+                delay = self._backoff(attempt)
+                logger.warning(f"🔄 Callback attempt {attempt}/{self.max_attempts} to {url} failed: {e}. Retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+        logger.error(f"❌ Failed to send callback: {error}")
+
+        if fallback is not None:
+            try:
+                await self._post(url, fallback(str(error)), headers)
+                logger.info(f"✅ Error callback sent successfully to {url}")
+                return self._finish(DeliveryResult(url, "fallback", attempt + 1, time.perf_counter() - start_time, str(error)))
+            except Exception as e:
+                logger.error(f"❌ Failed to send error callback after retry: {e}")
+                error = e
+                attempt += 1
+
+        return self._finish(DeliveryResult(url, "failed", attempt, time.perf_counter() - start_time, str(error)))
+
+    def _finish(self, result: DeliveryResult) -> DeliveryResult:
+        self.stats[result.outcome] += 1
+        log = logger.info if result.outcome == "ok" else logger.warning
+        log(f"📬 Callback to {result.url}: {result.outcome} after {result.attempts} attempt(s) in {result.latency:.3f}s")
+        if self.on_result is not None:
+            self.on_result(result)
+        return result
+
+    async def drain(self, timeout: float) -> bool:
+        """Waits up to ``timeout`` seconds for pending deliveries. Returns True if all finished."""
+        if not self._tasks:
+            return True
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"⏳ {len(pending)} callback(s) still pending after {timeout}s")
+        return not pending
+
+    async def aclose(self) -> None:
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+
+from callback_delivery import CallbackDelivery
+
+
+def make_delivery(handler, **kwargs):
+    kwargs.setdefault("base_delay", 0)
+    return CallbackDelivery(transport=httpx.MockTransport(handler), **kwargs)
+
+
+class TestCallbackDelivery(unittest.IsolatedAsyncioTestCase):
+    async def test_delivers_payload(self):
+        received = []
+
+        def handler(request):
+            received.append(request)
+            return httpx.Response(200)
+
+        delivery = make_delivery(handler)
+        result = await delivery.submit("https://example.com/callback", {"client_id": 1}, {"Authorization": "Bearer token"})
+
+        self.assertEqual(result.outcome, "ok")
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(received[0].headers["Authorization"], "Bearer token")
+        self.assertEqual(json.loads(received[0].read()), {"client_id": 1})
+        await delivery.aclose()
+
+    async def test_retries_then_succeeds(self):
+        statuses = [503, 503, 200]
+
+        def handler(request):
+            return httpx.Response(statuses.pop(0))
+
+        delivery = make_delivery(handler)
+        result = await delivery.submit("https://example.com/callback", {}, {})
+
+        self.assertEqual(result.outcome, "ok")
+        self.assertEqual(result.attempts, 3)
+        self.assertEqual(delivery.stats["attempts"], 3)
+        await delivery.aclose()
+
+    async def test_sends_fallback_on_client_error(self):
+        payloads = []
+
+        def handler(request):
+            payloads.append(request.read())
+            return httpx.Response(400 if len(payloads) == 1 else 200)
+
+        delivery = make_delivery(handler)
+        result = await delivery.submit("https://example.com/callback", {}, {}, fallback=lambda error: {"open_ai_status": "error"})
+
+        self.assertEqual(result.outcome, "fallback")
+        self.assertEqual(json.loads(payloads[1]), {"open_ai_status": "error"})
+        await delivery.aclose()
+
+    async def test_fails_on_request_that_cannot_be_built(self):
+        attempts = []
+
+        def handler(request):
+            attempts.append(request)
+            return httpx.Response(200)
+
+        results = []
+        delivery = make_delivery(handler, on_result=results.append)
+        invalid_header = await delivery.submit("https://example.com/callback", {}, {"Authorization": "Bearer тест"}, fallback=lambda error: {})
+        invalid_url = await delivery.submit("https://example.com:bad/callback", {}, {}, fallback=lambda error: {})
+
+        self.assertEqual([invalid_header.outcome, invalid_url.outcome], ["failed", "failed"])
+        # Not retried, only the fallback is tried once more
+        self.assertEqual(invalid_header.attempts, 2)
+        self.assertEqual(attempts, [])
+        self.assertEqual(delivery.stats["failed"], 2)
+        self.assertEqual(len(results), 2)
+        await delivery.aclose()
+
+    async def test_reuses_client_per_host(self):
+        delivery = make_delivery(lambda request: httpx.Response(200))
+        await asyncio.gather(
+            delivery.submit("https://example.com/a", {}, {}),
+            delivery.submit("https://example.com/b", {}, {}),
+            delivery.submit("https://other.com/a", {}, {}),
+        )
+
+        self.assertEqual(len(delivery._clients), 2)
+        self.assertTrue(await delivery.drain(timeout=1))
+        await delivery.aclose()
+
+
+if __name__ == "__main__":
+    unittest.main()
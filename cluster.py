@@ -0,0 +1,160 @@
+"""Multi-process deployment: a router in front of several app workers.
+
+Each worker is a separate ``uvicorn main:app`` process on its own local port.
+The router accepts the public traffic and forwards every POST to the worker
+that owns the request's thread_id, so a thread is only ever handled by one
+event loop and the per-thread scheduling in main.py stays correct.
+
+    python cluster.py --workers 4 --port 8000
+
+Across hosts, start the workers yourself with ``WORKER_INDEX=i WORKER_COUNT=n
+uvicorn main:app`` and run routers that only forward:
+
+    python cluster.py --worker-url http://pod-0:8000 --worker-url http://pod-1:8000
+
+Every router must list the same workers in the same order, the i-th URL being
+the worker started with WORKER_INDEX=i; a worker rejects threads it doesn't own
+with 421, so a misconfigured router fails loudly instead of running a thread
+twice. Nothing else is coordinated between hosts: the state backends (memory
+or SQLite) are per host, so dedup keys, cached thread lookups and the
+cluster_jobs gauge only cover the workers of one host, and the rate limit
+share assumes WORKER_COUNT workers in total. Dedup still works because a
+thread's requests always reach the same worker, but after WORKER_COUNT changes
+a thread may move to a worker that hasn't seen its pending keys.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Headers that describe the connection to the router rather than the request itself
+HOP_BY_HOP_HEADERS = {"host", "content-length", "connection", "keep-alive", "transfer-encoding"}
+
+
+def owner_of(thread_id: str, workers: int) -> int:
+    """Index of the worker that owns ``thread_id``. Stable across processes, unlike hash()."""
+    digest = hashlib.blake2b(thread_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % workers
+
+
+def create_router(worker_urls: list, transport: httpx.AsyncBaseTransport = None) -> FastAPI:
+    http = httpx.AsyncClient(
+        timeout=30, transport=transport, limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+    )
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        await http.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+
+    async def forward(worker: int, request: Request, path: str, body: bytes = b"") -> Response:
+        headers = {name: value for name, value in request.headers.items() if name not in HOP_BY_HOP_HEADERS}
+        try:
+            response = await http.request(request.method, worker_urls[worker] + path, content=body, headers=headers)
+        except httpx.TransportError as e:
+            logger.error(f"❌ Worker {worker} is unreachable: {e}")
+            return Response(status_code=503, headers={"Retry-After": "5"})
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            headers={name: value for name, value in response.headers.items() if name not in HOP_BY_HOP_HEADERS},
+        )
+
+    @app.post("/")
+    async def route_chat(request: Request):
+        body = await request.body()
+        try:
+            thread_id = str(json.loads(body).get("thread_id") or "")
+        except (ValueError, AttributeError):
+            thread_id = ""
+        # Requests without a thread_id are rejected by any worker, so they all go to the first one
+        return await forward(owner_of(thread_id, len(worker_urls)) if thread_id else 0, request, "/", body)
+
+    @app.get("/metrics/{worker}")
+    async def worker_metrics(worker: int, request: Request):
+        if not 0 <= worker < len(worker_urls):
+            return Response(status_code=404)
+        return await forward(worker, request, "/metrics")
+
+    return app
+
+
+def start_worker(index: int, workers: int, port: int, log_level: str) -> subprocess.Popen:
+    env = {**os.environ, "WORKER_INDEX": str(index), "WORKER_COUNT": str(workers)}
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", log_level]
+    return subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+async def supervise(processes: list, start, stop_event: asyncio.Event) -> None:
+    # Restarts workers that exit on their own; the thread_ids they own wait for them meanwhile
+    while not stop_event.is_set():
+        for index, process in enumerate(processes):
+            if process.poll() is not None:
+                logger.error(f"💥 Worker {index} exited with code {process.returncode}, restarting")
+                processes[index] = start(index)
+        await asyncio.sleep(1)
+
+
+def run_cluster(workers: int, host: str = "0.0.0.0", port: int = 8000, worker_base_port: int = 9000, log_level: str = "info") -> None:
+    ports = [worker_base_port + index for index in range(workers)]
+
+    def start(index: int) -> subprocess.Popen:
+        return start_worker(index, workers, ports[index], log_level)
+
+    processes = [start(index) for index in range(workers)]
+    router = create_router([f"http://127.0.0.1:{worker_port}" for worker_port in ports])
+
+    async def serve():
+        stop_event = asyncio.Event()
+        supervisor = asyncio.create_task(supervise(processes, start, stop_event))
+        try:
+            await uvicorn.Server(uvicorn.Config(router, host=host, port=port, log_level=log_level)).serve()
+        finally:
+            stop_event.set()
+            await supervisor
+
+    # uvicorn re-raises the signal that stopped it; exiting through SystemExit lets the workers be stopped below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        asyncio.run(serve())
+    finally:
+        # Workers drain their queues and callbacks on SIGTERM
+        for process in processes:
+            process.terminate()
+        deadline = time.time() + float(os.getenv('SHUTDOWN_TIMEOUT', 30)) + 5
+        for process in processes:
+            try:
+                process.wait(timeout=max(deadline - time.time(), 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--worker-base-port", type=int, default=9000, help="Workers listen on consecutive local ports from here")
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--worker-url", action="append", default=[], help="Only route, to workers already running at these URLs, in WORKER_INDEX order")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.worker_url:
+        uvicorn.run(create_router(args.worker_url), host=args.host, port=args.port, log_level=args.log_level)
+    else:
+        run_cluster(args.workers, args.host, args.port, args.worker_base_port, args.log_level)
@@ -0,0 +1,86 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import httpx
+
+from cluster import create_router, owner_of
+
+WORKER_URLS = ["http://worker-0", "http://worker-1", "http://worker-2"]
+
+
+class TestOwnerOf(unittest.TestCase):
+    def test_is_stable_across_processes(self):
+        thread_ids = [f"thread_{i}" for i in range(20)]
+        script = f"from cluster import owner_of; print([owner_of(t, 3) for t in {thread_ids!r}])"
+        # hash() would differ between these processes
+        outputs = {
+            subprocess.run(
+                [sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, "PYTHONHASHSEED": seed},
+            ).stdout
+            for seed in ("1", "2")
+        }
+
+        self.assertEqual(outputs, {f"{[owner_of(t, 3) for t in thread_ids]}\n"})
+
+    def test_spreads_threads_over_workers(self):
+        owners = [owner_of(f"thread_{i}", 4) for i in range(400)]
+
+        self.assertEqual(set(owners), {0, 1, 2, 3})
+        self.assertGreater(min(owners.count(worker) for worker in range(4)), 60)
+
+
+class TestRouter(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.forwarded = []
+        self.down = set()
+
+        def worker(request):
+            if request.url.host in self.down:
+                raise httpx.ConnectError("connection refused", request=request)
+            self.forwarded.append(request)
+            return httpx.Response(200, json={"worker": request.url.host}, headers={"X-Worker": request.url.host})
+
+        router = create_router(WORKER_URLS, transport=httpx.MockTransport(worker))
+        self.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=router), base_url="http://router")
+
+    async def asyncTearDown(self):
+        await self.http.aclose()
+
+    async def test_forwards_to_owner_of_thread(self):
+        body = {"thread_id": "thread_7", "message": "Hi"}
+
+        response = await self.http.post("/", json=body, headers={"Idempotency-Key": "key-1"})
+
+        self.assertEqual(response.json(), {"worker": f"worker-{owner_of('thread_7', 3)}"})
+        self.assertEqual(response.headers["X-Worker"], f"worker-{owner_of('thread_7', 3)}")
+        self.assertEqual(json.loads(self.forwarded[0].read()), body)
+        self.assertEqual(self.forwarded[0].headers["Idempotency-Key"], "key-1")
+        self.assertEqual(self.forwarded[0].url.path, "/")
+
+    async def test_request_without_thread_goes_to_first_worker(self):
+        await self.http.post("/", content=b"not json")
+
+        self.assertEqual(self.forwarded[0].url.host, "worker-0")
+
+    async def test_unreachable_worker_returns_503(self):
+        self.down.add(f"worker-{owner_of('thread_7', 3)}")
+
+        response = await self.http.post("/", json={"thread_id": "thread_7"})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+    async def test_proxies_worker_metrics(self):
+        response = await self.http.get("/metrics/2")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.forwarded[0].url, "http://worker-2/metrics")
+        self.assertEqual((await self.http.get("/metrics/3")).status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from dedup import DedupStore, request_key, STATUS_DONE, STATUS_PENDING
+from state import AsyncBackend, SQLiteBackend
+
+
+class TestDedupStore(unittest.IsolatedAsyncioTestCase):
+    async def test_claims_once(self):
+        store = DedupStore()
+
+        self.assertIsNone(await store.claim("key"))
+        self.assertEqual(await store.claim("key"), STATUS_PENDING)
+        await store.complete("key")
+        self.assertEqual(await store.claim("key"), STATUS_DONE)
+
+    async def test_forget_allows_retry(self):
+        store = DedupStore()
+        await store.claim("key")
+        await store.forget("key")
+
+        self.assertIsNone(await store.claim("key"))
+
+    async def test_window_expires(self):
+        store = DedupStore(window=0)
+        await store.claim("key")
+        await store.complete("key")
+
+        self.assertIsNone(await store.claim("key"))
+
+    async def test_complete_with_shorter_window(self):
+        store = DedupStore()
+        await store.claim("key")
+        await store.complete("key", window=0)
+
+        self.assertIsNone(await store.claim("key"))
+
+    async def test_lost_pending_key_expires(self):
+        store = DedupStore(pending_ttl=0)
+        await store.claim("key")
+
+        self.assertIsNone(await store.claim("key"))
+
+    async def test_hold_extends_pending_key(self):
+        store = DedupStore(pending_ttl=0)
+        await store.claim("key")
+        await store.hold("key", 60)
+
+        self.assertEqual(await store.claim("key"), STATUS_PENDING)
+
+    async def test_keys_are_shared_and_survive_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "state.sqlite")
+            store = DedupStore(AsyncBackend(SQLiteBackend(path)))
+            await store.claim("done")
+            await store.complete("done")
+            await store.claim("running")
+
+            other_process = DedupStore(AsyncBackend(SQLiteBackend(path)))
+            self.assertEqual(await other_process.claim("done"), STATUS_DONE)
+            self.assertEqual(await other_process.claim("running"), STATUS_PENDING)
+
+    def test_request_key_depends_on_content(self):
+        self.assertEqual(request_key("thread", 1, "hi"), request_key("thread", 1, "hi"))
+        self.assertNotEqual(request_key("thread", 1, "hi"), request_key("thread", 2, "hi"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    def __init__(self, message: str, closed: bool = False):
+        super().__init__(message)
+        self.closed = closed
+
+
+class JobQueue:
+    """Bounded queue of background jobs executed by a fixed number of workers.
+
+    ``submit`` never blocks: when the queue is full or shutting down it raises
+    QueueFullError so the caller can reject the request straight away. Like a
+    task, each job runs in a copy of the context it was submitted from, so
+    context variables set by one job don't leak into the next on the same worker.
+    """
+
+    def __init__(self, workers: int = 8, maxsize: int = 100):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._worker_tasks: list[asyncio.Task] = []
+        self._closed = False
+        self.busy = 0
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "cancelled": 0}
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def utilisation(self) -> float:
+        return self.busy / self.workers if self.workers else 0.0
+
+    @property
+    def accepting(self) -> bool:
+        return not self._closed
+
+    def start(self) -> None:
+        self._closed = False
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(asyncio.create_task(self._worker()))
+
+    def submit(self, job: Callable[[], Awaitable]) -> asyncio.Future:
+        """Queues ``job`` and returns a future resolved with its result."""
+        if self._closed:
+            self.stats["rejected"] += 1
+            raise QueueFullError("Job queue is shutting down", closed=True)
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((job, future, contextvars.copy_context()))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise QueueFullError(f"Job queue is full ({self.maxsize} jobs waiting)")
+        self.stats["submitted"] += 1
+        return future
+
+    async def _worker(self) -> None:
+        while True:
+            job, future, context = await self._queue.get()
+            self.busy += 1
+            try:
+                result = await asyncio.create_task(job(), context=context)
+                self.stats["completed"] += 1
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                self.stats["cancelled"] += 1
+                future.cancel()
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"❌ Background job failed: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.busy -= 1
+                self._queue.task_done()
+
+    async def shutdown(self, timeout: float) -> bool:
+        """Stops intake and waits up to ``timeout`` seconds for queued and running jobs.
+
+        Jobs still unfinished at the deadline are cancelled. Returns True if everything drained.
+        """
+        self._closed = True
+        start_time = time.time()
+        logger.info(f"🛑 Draining job queue: {self.depth} queued, {self.busy} running")
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            drained = True
+        except asyncio.TimeoutError:
+            drained = False
+            logger.warning(f"⏳ Job queue not drained after {timeout}s, cancelling {self.depth} queued and {self.busy} running jobs")
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks.clear()
+
+        while not self._queue.empty():
+            job, future, context = self._queue.get_nowait()
+            future.cancel()
+            self._queue.task_done()
+
+        logger.info(f"🛑 Job queue stopped in {time.time() - start_time:.2f}s")
+        return drained
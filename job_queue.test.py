@@ -0,0 +1,87 @@
+import asyncio
+import contextvars
+import unittest
+
+from job_queue import JobQueue, QueueFullError
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class TestJobQueue(unittest.IsolatedAsyncioTestCase):
+    async def test_runs_jobs_on_limited_workers(self):
+        queue = JobQueue(workers=2, maxsize=10)
+        queue.start()
+        running = []
+        peak = []
+
+        async def job():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            return "done"
+
+        results = await asyncio.gather(*(queue.submit(job) for _ in range(5)))
+
+        self.assertEqual(results, ["done"] * 5)
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(queue.stats["completed"], 5)
+        await queue.shutdown(timeout=1)
+
+    async def test_jobs_run_in_the_context_they_were_submitted_from(self):
+        queue = JobQueue(workers=1, maxsize=10)
+        queue.start()
+
+        async def job():
+            seen = request_id.get()
+            request_id.set("set by job")
+            return seen
+
+        request_id.set("first")
+        first = queue.submit(job)
+        request_id.set(None)
+        second = queue.submit(job)
+
+        self.assertEqual(await asyncio.gather(first, second), ["first", None])
+        await queue.shutdown(timeout=1)
+
+    async def test_rejects_when_full(self):
+        queue = JobQueue(workers=1, maxsize=1)
+        queue.submit(lambda: asyncio.sleep(0))
+
+        with self.assertRaises(QueueFullError) as context:
+            queue.submit(lambda: asyncio.sleep(0))
+        self.assertFalse(context.exception.closed)
+        self.assertEqual(queue.depth, 1)
+        await queue.shutdown(timeout=0)
+
+    async def test_shutdown_drains_then_rejects(self):
+        queue = JobQueue(workers=1, maxsize=10)
+        queue.start()
+        finished = []
+
+        async def job():
+            await asyncio.sleep(0.01)
+            finished.append(1)
+
+        queue.submit(job)
+        queue.submit(job)
+        self.assertTrue(await queue.shutdown(timeout=1))
+        self.assertEqual(len(finished), 2)
+
+        with self.assertRaises(QueueFullError) as context:
+            queue.submit(job)
+        self.assertTrue(context.exception.closed)
+
+    async def test_shutdown_cancels_after_deadline(self):
+        queue = JobQueue(workers=1, maxsize=10)
+        queue.start()
+        future = queue.submit(lambda: asyncio.sleep(10))
+        await asyncio.sleep(0)
+
+        self.assertFalse(await queue.shutdown(timeout=0.01))
+        self.assertTrue(future.cancelled())
+
+
+if __name__ == "__main__":
+    unittest.main()
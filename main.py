@@ -1,13 +1,28 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, PrivateAttr
+from typing import Optional
+import httpx
 import openai
 from openai import AsyncOpenAI
-import requests
 import logging
 from dotenv import load_dotenv
 import os
 import asyncio
 import time 
+import math
+import uuid
+import contextvars
+from contextlib import asynccontextmanager
+from callback_delivery import CallbackDelivery
+from thread_scheduler import ThreadScheduler
+from job_queue import JobQueue, QueueFullError
+from ttl_cache import TTLCache
+from dedup import DedupStore, request_key, STATUS_PENDING
+from state import create_backend
+from cluster import owner_of
+from rate_limit import RateLimiter, RateLimitExceeded, count_tokens, load_encoding, PRIORITY_HIGH, PRIORITY_NORMAL
+from metrics import Registry
 
 load_dotenv()
 GPT_TOKEN = os.getenv('GPT_TOKEN')
@@ -15,14 +30,157 @@ GPT_TOKEN = os.getenv('GPT_TOKEN')
 if GPT_TOKEN is None:
     raise RuntimeError("GPT_TOKEN is not set in .env file")
 
+# Trace id of the request being handled, added to every log line written while handling it
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        trace_id = trace_id_var.get()
+        record.trace_id = f"[{trace_id}] " if trace_id else ""
+        return True
+
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(trace_id)s%(message)s")
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
+
+metrics = Registry()
+STAGE_SECONDS = metrics.histogram("chat_stage_seconds", "Time spent in each stage of a chat request")
+RUN_POLLS = metrics.histogram("chat_run_polls", "runs.retrieve calls made for a completed run", buckets=(0, 1, 2, 5, 10, 20, 50))
+RUN_ATTEMPTS = metrics.counter("chat_run_attempts_total", "Run attempts, including retries")
+RUN_RETRIES = metrics.counter("chat_run_retries_total", "Run attempts that retried a failed attempt")
+RUN_RESULTS = metrics.counter("chat_runs_total", "Chat completions by result")
+CALLBACKS = metrics.counter("chat_callbacks_total", "Callback deliveries by outcome")
+END_TO_END_SECONDS = metrics.histogram(
+    "chat_end_to_end_seconds", "Time from the POST to the delivered callback", buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+)
+EVENT_LOOP_LAG_SECONDS = metrics.histogram(
+    "event_loop_lag_seconds", "How late the event loop woke up a sleeping task", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+EVENT_LOOP_LAG_INTERVAL = 0.1
 
-app = FastAPI()
 openai.api_key = GPT_TOKEN
 
 client = AsyncOpenAI(api_key=GPT_TOKEN)
 
+# "stream" consumes the run event stream, "poll" polls the run status with backoff
+RUN_COMPLETION_MODE = os.getenv('RUN_COMPLETION_MODE', 'stream')
+POLL_INITIAL_INTERVAL = float(os.getenv('POLL_INITIAL_INTERVAL', 0.2))
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', 2))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', 1.5))
+
+
+
+def observe_callback(result):
+    STAGE_SECONDS.observe(result.latency, stage="callback")
+    CALLBACKS.inc(outcome=result.outcome)
+
+
+CALLBACK_BASE_URL = os.getenv('CALLBACK_BASE_URL', 'https://chatter.salebot.pro')
+callback_delivery = CallbackDelivery(
+    max_concurrency=int(os.getenv('CALLBACK_MAX_CONCURRENCY', 20)),
+    max_attempts=int(os.getenv('CALLBACK_MAX_ATTEMPTS', 4)),
+    timeout=float(os.getenv('CALLBACK_TIMEOUT', 60)),
+    on_result=observe_callback,
+)
+
+# Position of this process among the workers started by cluster.py, each owns a share of the thread_ids
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', 0))
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 1))
+
+# State shared between workers: "memory://" (this process only) or "sqlite:///path/to/state.db"
+DEDUP_SQLITE_PATH = os.getenv('DEDUP_SQLITE_PATH')
+STATE_BACKEND_URL = os.getenv('STATE_BACKEND_URL') or (f"sqlite:///{DEDUP_SQLITE_PATH}" if DEDUP_SQLITE_PATH else "memory://")
+state_backend = create_backend(STATE_BACKEND_URL)
+
+# Validated thread ids, so each turn doesn't pay for a threads.retrieve round-trip.
+# Entries are kept locally and in state_backend, so they outlive a restart or a change of worker count
+THREAD_CACHE_TTL = float(os.getenv('THREAD_CACHE_TTL', 600))
+thread_cache = TTLCache(
+    maxsize=int(os.getenv('THREAD_CACHE_SIZE', 10000)),
+    ttl=THREAD_CACHE_TTL,
+)
+THREAD_NOT_FOUND_TTL = float(os.getenv('THREAD_NOT_FOUND_TTL', 30))
+_MISSING = object()
+
+rate_limiter = RateLimiter(
+    rpm=float(os.getenv('RATE_LIMIT_RPM', 500)),
+    tpm=float(os.getenv('RATE_LIMIT_TPM', 200000)),
+    max_wait=float(os.getenv('RATE_LIMIT_MAX_WAIT', 10)),
+    share=1 / WORKER_COUNT,
+)
+RUN_TOKEN_OVERHEAD = int(os.getenv('RUN_TOKEN_OVERHEAD', 1500))
+
+# Duplicate webhook deliveries within DEDUP_WINDOW seconds join the first request's job.
+# Without an idempotency key a request is identified by its content, and a user may well send
+# the same "ok" twice, so such keys are only kept for DEDUP_CONTENT_WINDOW, long enough for webhook retries
+DEDUP_WINDOW = float(os.getenv('DEDUP_WINDOW', 600))
+DEDUP_CONTENT_WINDOW = float(os.getenv('DEDUP_CONTENT_WINDOW', 30))
+
+# Seconds a chat completion may take, retries included
+RUN_TIMEOUT = float(os.getenv('RUN_TIMEOUT', 60))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 8))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 100))
+MAX_COALESCED_MESSAGES = int(os.getenv('MAX_COALESCED_MESSAGES', 10))
+THREAD_MAX_PENDING = int(os.getenv('THREAD_MAX_PENDING', 50))
+
+# A claimed key stays pending while its request waits for the jobs ahead of it and for the earlier batches on
+# its thread, estimated at a full RUN_TIMEOUT each. It must not expire before then, or a webhook retry starts a
+# second run; it only has to expire eventually so a job lost with its worker doesn't block retries forever.
+# Once the request's batch starts, its key is held for the run itself (see process_batch)
+DEDUP_PENDING_TTL = float(os.getenv('DEDUP_PENDING_TTL', 0)) or RUN_TIMEOUT * (
+    math.ceil(JOB_QUEUE_SIZE / JOB_WORKERS) + math.ceil(THREAD_MAX_PENDING / MAX_COALESCED_MESSAGES) + 1
+)
+dedup_store = DedupStore(state_backend, window=DEDUP_WINDOW, pending_ttl=DEDUP_PENDING_TTL)
+
+job_queue = JobQueue(workers=JOB_WORKERS, maxsize=JOB_QUEUE_SIZE)
+# Seconds a client is asked to wait before retrying when the job queue is saturated
+QUEUE_RETRY_AFTER = int(os.getenv('QUEUE_RETRY_AFTER', 5))
+QUEUE_DEPTH_TTL = 5
+# Jobs queued or running across the workers sharing state_backend, refreshed by publish_queue_depth
+cluster_jobs = 0
+
+
+async def monitor_event_loop_lag():
+    # Anything blocking the loop shows up as the sleep overshooting its interval
+    while True:
+        start_time = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG_SECONDS.observe(max(time.perf_counter() - start_time - EVENT_LOOP_LAG_INTERVAL, 0))
+
+
+async def publish_queue_depth():
+    # Lets any worker report the queue depth of the whole cluster
+    global cluster_jobs
+    while True:
+        try:
+            await state_backend.set(f"queue_depth:{WORKER_INDEX}", job_queue.depth + job_queue.busy, QUEUE_DEPTH_TTL)
+            cluster_jobs = sum((await state_backend.items("queue_depth:")).values())
+        except Exception as e:
+            logger.warning(f"⚠️ Could not publish queue depth: {e}")
+        await asyncio.sleep(1)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_queue.start()
+    background = [asyncio.create_task(monitor_event_loop_lag()), asyncio.create_task(publish_queue_depth())]
+    # tiktoken may download its encoding, token counts are estimated from length until it is loaded
+    background.append(asyncio.create_task(asyncio.to_thread(load_encoding)))
+    yield
+    for task in background:
+        task.cancel()
+    # Stop taking requests, let in-flight runs finish and their callbacks go out
+    deadline = time.time() + float(os.getenv('SHUTDOWN_TIMEOUT', 30))
+    await job_queue.shutdown(timeout=max(deadline - time.time(), 0))
+    await callback_delivery.drain(timeout=max(deadline - time.time(), 0))
+    await callback_delivery.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
 class ChatRequest(BaseModel):
     thread_id: str
     asst_id: str
@@ -30,9 +188,13 @@ class ChatRequest(BaseModel):
     client_id: int
     message: str
     callback_text: str
+    idempotency_key: Optional[str] = None
+    trace_id: Optional[str] = None
+    _received_at: float = PrivateAttr(default_factory=time.time)
+    _dedup_window: float = PrivateAttr(default=None)
 
 
-async def send_callback(callback_url, api_key, client_id, open_ai_text, open_ai_status, open_ai_error, callback_text):
+async def send_callback(callback_url, api_key, client_id, open_ai_text=None, open_ai_status=None, open_ai_error=None, callback_text=None, received_at=None):
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -51,86 +213,232 @@ async def send_callback(callback_url, api_key, client_id, open_ai_text, open_ai_
     if open_ai_error:
         data["open_ai_error"] = open_ai_error
 
-    try:
-        response = requests.post(callback_url, json=data, headers=headers, timeout=60)
-        response.raise_for_status()
-        logger.info(f"✅ Callback sent successfully to {callback_url}")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Failed to send callback: {e}")
-
+    def error_payload(error):
         # If the callback is not sent, try to resend with error information
-        error_data = {
+        return {
             "message": callback_text,
             "client_id": client_id,
             "open_ai_status": "error",
-            "open_ai_error": f"Callback failed due to: {e}"
+            "open_ai_error": f"Callback failed due to: {error}"
         }
 
-        logger.info(f"Sending callback to {callback_url} with status {open_ai_status}, error: {open_ai_error}")
+    logger.info(f"Sending callback to {callback_url} with status {open_ai_status}, error: {open_ai_error}")
+    task = callback_delivery.submit(callback_url, data, headers, fallback=error_payload)
+    if received_at is not None:
+        task.add_done_callback(lambda task: task.cancelled() or END_TO_END_SECONDS.observe(time.time() - received_at))
+    return task
 
-        try:
-            error_response = requests.post(callback_url, json=error_data, headers=headers, timeout=60)
-            error_response.raise_for_status()
-            logger.info(f"✅ Error callback sent successfully to {callback_url}")
-        except requests.exceptions.RequestException as retry_exception:
-            logger.error(f"❌ Failed to send error callback after retry: {retry_exception}")
 
+class RunFailedError(Exception):
+    pass
+
+
+RUN_TERMINAL_STATUSES = {"failed", "cancelled", "expired", "requires_action", "incomplete"}
+RUN_TERMINAL_EVENTS = {f"thread.run.{status}" for status in RUN_TERMINAL_STATUSES}
+
+
+def _run_error(run) -> str:
+    last_error = getattr(run, "last_error", None)
+    details = f": {last_error.message}" if last_error else ""
+    return f"Run {run.id} ended with status {run.status}{details}"
 
-async def stream_chat_completion(thread_id: str, asst_id: str, user_message: str, retries: int = 3, timeout_limit: int = 60):
-    messages = []
-    attempt = 0
-    init_message = user_message
-    start_time = time.time()
 
-    # Check if the thread exists
+async def cancel_run(thread_id: str, run_id: str, stats: dict) -> None:
+    # A run left active blocks the thread: the next batch's runs.create would fail until it expires
+    stats["api_calls"] += 1
     try:
-        await client.beta.threads.retrieve(thread_id=thread_id)
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id, timeout=10)
+        logger.info(f"🛑 Cancelled run {run_id} on thread {thread_id}")
     except Exception as e:
-        logger.error(f"❌ Error: No thread found with id {thread_id}. Details: {e}")
-        return '', f"No thread found with id {thread_id}"
+        logger.error(f"❌ Could not cancel run {run_id} on thread {thread_id}: {e}")
 
-    while attempt < retries:
-        attempt += 1
-        try:
-            logger.info(f"🚀 Attempt {attempt}/{retries} for thread {thread_id}, message: {init_message}")
-            
-            response_run_create = await client.beta.threads.runs.create(
+
+async def create_run(thread_id: str, asst_id: str, messages: list, stats: dict, priority: int = PRIORITY_NORMAL, **kwargs):
+    # The run also bills the thread history and the reply, RUN_TOKEN_OVERHEAD stands in for them
+    stats["estimated_tokens"] = RUN_TOKEN_OVERHEAD + sum(count_tokens(message) for message in messages)
+    with STAGE_SECONDS.time(stage="rate_limit_wait"):
+        await rate_limiter.acquire(stats["estimated_tokens"], priority)
+
+    stats["api_calls"] += 1
+    try:
+        with STAGE_SECONDS.time(stage="run_create"):
+            # The SDK's own 429 retries would bypass rate_limiter, stream_chat_completion retries instead
+            response = await client.with_options(max_retries=0).beta.threads.runs.with_raw_response.create(
                 thread_id=thread_id,
                 assistant_id=asst_id,
                 additional_messages=[
-                    {"role": "user", "content": init_message}
+                    {"role": "user", "content": message} for message in messages
                 ],
                 model="gpt-4o-mini",
                 timeout=60,
+                **kwargs,
             )
+    except openai.RateLimitError as e:
+        rate_limiter.update_from_headers(e.response.headers)
+        raise
+    rate_limiter.update_from_headers(response.headers)
+    return response.parse()
+
+
+async def stream_run(thread_id: str, asst_id: str, messages: list, stats: dict, priority: int = PRIORITY_NORMAL) -> str:
+    # Consumes the run event stream, so the reply is available as soon as the run finishes
+    stream = await create_run(thread_id, asst_id, messages, stats, priority, stream=True)
+    text = None
+    with STAGE_SECONDS.time(stage="run_wait"):
+        async with stream:
+            async for event in stream:
+                if event.event == "thread.run.created":
+                    stats["run_id"] = event.data.id
+                elif event.event == "thread.message.completed":
+                    text = event.data.content[0].text.value.strip()
+                elif event.event == "thread.run.completed":
+                    stats["usage"] = event.data.usage
+                    break
+                elif event.event in RUN_TERMINAL_EVENTS:
+                    if event.data.status == "requires_action":
+                        await cancel_run(thread_id, event.data.id, stats)
+                    raise RunFailedError(_run_error(event.data))
+                elif event.event == "error":
+                    raise RunFailedError(f"Stream error: {event.data.message}")
+
+    if text is None:
+        raise RuntimeError(f"Run stream for thread {thread_id} ended without a message")
+    return text
+
+
+async def poll_run(thread_id: str, run_id: str, stats: dict) -> str:
+    # Starts polling fast and backs off, most runs finish within a few seconds
+    interval = POLL_INITIAL_INTERVAL
+    with STAGE_SECONDS.time(stage="run_wait"):
+        while True:
+            stats["api_calls"] += 1
+            stats["polls"] += 1
+            response_retrieve = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+            logger.info(f"🔄 Polling for completion... (status: {response_retrieve.status})")
+            if response_retrieve.status == "completed":
+                stats["usage"] = response_retrieve.usage
+                break
+            if response_retrieve.status in RUN_TERMINAL_STATUSES:
+                if response_retrieve.status == "requires_action":
+                    await cancel_run(thread_id, run_id, stats)
+                raise RunFailedError(_run_error(response_retrieve))
+            await asyncio.sleep(interval)
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+    stats["api_calls"] += 1
+    with STAGE_SECONDS.time(stage="messages_list"):
+        message_response = await client.beta.threads.messages.list(thread_id=thread_id, run_id=run_id, limit=1, order="desc")
+    return message_response.data[0].content[0].text.value.strip()
+
+
+async def run_to_completion(thread_id: str, asst_id: str, messages: list, stats: dict, priority: int = PRIORITY_NORMAL) -> str:
+    if RUN_COMPLETION_MODE == "stream":
+        try:
+            return await stream_run(thread_id, asst_id, messages, stats, priority)
+        except (RunFailedError, RateLimitExceeded, openai.APIStatusError):
+            raise
+        except Exception as e:
+            # Polling only helps once the run exists or the stream's connection broke; a failed runs.create
+            # is retried by stream_chat_completion, not sent again here
+            if stats.get("run_id") is None and not isinstance(e, httpx.TransportError):
+                raise
+            logger.warning(f"⚠️ Run stream failed for thread {thread_id}, falling back to polling: {e}")
+
+    if stats.get("run_id") is None:
+        response_run_create = await create_run(thread_id, asst_id, messages, stats, priority)
+        stats["run_id"] = response_run_create.id
+    return await poll_run(thread_id, stats["run_id"], stats)
+
+
+async def validate_thread(thread_id: str):
+    # Returns an error message if the thread does not exist, results are cached in thread_cache
+    cached = thread_cache.get(thread_id, _MISSING)
+    if cached is not _MISSING:
+        return cached
+
+    # The shared backend stores "" for a valid thread, it can't hold None
+    shared = await state_backend.get(f"thread:{thread_id}")
+    if shared is not None:
+        thread_cache.set(thread_id, shared or None)
+        return shared or None
 
-            while True:
-                elapsed_time = time.time() - start_time
-                if elapsed_time > timeout_limit:
-                    logger.error(f"⏳ Timeout reached: {elapsed_time:.2f} seconds. Retrying...")
-                    raise TimeoutError 
+    try:
+        await client.beta.threads.retrieve(thread_id=thread_id)
+    except Exception as e:
+        logger.error(f"❌ Error: No thread found with id {thread_id}. Details: {e}")
+        error = f"No thread found with id {thread_id}"
+        # Only a definite "not found" is cached, transient API errors are retried on the next request
+        if isinstance(e, openai.NotFoundError):
+            thread_cache.set(thread_id, error, ttl=THREAD_NOT_FOUND_TTL)
+            await state_backend.set(f"thread:{thread_id}", error, THREAD_NOT_FOUND_TTL)
+        return error
 
-                response_retrieve = await client.beta.threads.runs.retrieve(
-                    thread_id=thread_id, run_id=response_run_create.id
-                )
-                logger.info(f"🔄 Polling for completion... (status: {response_retrieve.status})")
-                if response_retrieve.status == "completed":
-                    break
-                await asyncio.sleep(1)
+    thread_cache.set(thread_id, None)
+    await state_backend.set(f"thread:{thread_id}", "", THREAD_CACHE_TTL)
+    return None
 
-            if response_retrieve.status == "completed":
-                message_response = await client.beta.threads.messages.list(thread_id=thread_id)
-                message_chunk = message_response.data[0].content[0].text.value.strip()
-                messages.append(message_chunk)
 
-                return ''.join(messages), None
+async def stream_chat_completion(thread_id: str, asst_id: str, user_message: str, retries: int = 3, timeout_limit: int = 60):
+    attempt = 0
+    # Several messages coalesced by the thread scheduler are sent in one run
+    init_messages = user_message if isinstance(user_message, list) else [user_message]
+    start_time = time.time()
+
+    with STAGE_SECONDS.time(stage="thread_validate"):
+        thread_error = await validate_thread(thread_id)
+    if thread_error:
+        RUN_RESULTS.inc(result="thread_not_found")
+        return '', thread_error
+
+    while attempt < retries:
+        attempt += 1
+        stats = {"api_calls": 0, "polls": 0, "run_id": None, "estimated_tokens": 0, "usage": None}
+        RUN_ATTEMPTS.inc()
+        if attempt > 1:
+            RUN_RETRIES.inc()
+        run_start = time.time()
+        try:
+            logger.info(f"🚀 Attempt {attempt}/{retries} for thread {thread_id}, message: {init_messages}")
+
+            remaining = timeout_limit - (time.time() - start_time)
+            if remaining <= 0:
+                RUN_RESULTS.inc(result="timeout")
+                return '', f"Timed out after {timeout_limit}s"
+            try:
+                message_chunk = await asyncio.wait_for(
+                    # Retries already spent budget on this conversation, so they may wait longer for more
+                    run_to_completion(thread_id, asst_id, init_messages, stats, PRIORITY_HIGH if attempt > 1 else PRIORITY_NORMAL),
+                    timeout=remaining,
+                )
+            except asyncio.TimeoutError:
+                # The whole budget is spent, so there is no point in another attempt
+                logger.error(f"⏳ Timeout reached: {time.time() - start_time:.2f} seconds")
+                if stats["run_id"]:
+                    await cancel_run(thread_id, stats["run_id"], stats)
+                RUN_RESULTS.inc(result="timeout")
+                return '', f"Timed out after {timeout_limit}s"
+
+            if stats["usage"]:
+                rate_limiter.settle(stats["estimated_tokens"], stats["usage"].total_tokens)
+            RUN_POLLS.observe(stats["polls"])
+            RUN_RESULTS.inc(result="ok")
+            logger.info(f"🏁 Run {stats['run_id']} completed in {time.time() - run_start:.2f}s with {stats['api_calls']} API calls ({RUN_COMPLETION_MODE})")
+            return message_chunk, None
+
+        except RateLimitExceeded as e:
+            logger.error(f"🚦 Request for thread {thread_id} shed by rate limiter: {e}")
+            RUN_RESULTS.inc(result="shed")
+            return '', str(e)
 
         except Exception as e:
             logger.error(f"❌ Error during streaming attempt {attempt}: {e}")
             if attempt < retries:
                 logger.info(f"🔄 Retrying... (attempt {attempt + 1}/{retries})")
-                await asyncio.sleep(0.5)
+                # After a 429 the rate limiter holds the next attempt until the API allows it
+                if not isinstance(e, openai.RateLimitError):
+                    await asyncio.sleep(0.5)
             else:
+                RUN_RESULTS.inc(result="error")
                 return '', str(e)
 
     return '', 'Max retries exceeded'
@@ -138,43 +446,133 @@ async def stream_chat_completion(thread_id: str, asst_id: str, user_message: str
 
 
 @app.post("/")
-async def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, idempotency_key: Optional[str] = Header(None), x_trace_id: Optional[str] = Header(None)):
+    req.trace_id = req.trace_id or x_trace_id or uuid.uuid4().hex[:12]
+    trace_id_var.set(req.trace_id)
     logger.info("Received chat request: %s\n\n", req.dict())
     if not req.thread_id:
         logger.error("⚠️ No thread_id provided. Cannot proceed without a thread.")
         raise HTTPException(status_code=400, detail="thread_id must be provided")
 
-    asyncio.create_task(process_request(req))
+    # Only the owning worker may run a thread, otherwise two event loops could race on it
+    if WORKER_COUNT > 1 and owner_of(req.thread_id, WORKER_COUNT) != WORKER_INDEX:
+        logger.error(f"⚠️ Thread {req.thread_id} belongs to worker {owner_of(req.thread_id, WORKER_COUNT)}, not {WORKER_INDEX}")
+        raise HTTPException(status_code=421, detail="Request was routed to the wrong worker")
+
+    # Salebot retries webhooks, a repeated request joins the job of the first one
+    req.idempotency_key = req.idempotency_key or idempotency_key
+    if not req.idempotency_key:
+        req.idempotency_key = request_key(req.thread_id, req.client_id, req.message, req.callback_text)
+        req._dedup_window = DEDUP_CONTENT_WINDOW
+    status = await dedup_store.claim(req.idempotency_key)
+    if status is not None:
+        dedup_store.record_duplicate(RUN_TOKEN_OVERHEAD + count_tokens(req.message))
+        logger.info(f"♻️ Duplicate request for thread {req.thread_id} ({status}), not starting a new run")
+        if status == STATUS_PENDING:
+            return {"status": "ok", "message": "Processing started"}
+        return {"status": "ok", "message": "Already processed"}
+
+    try:
+        thread_scheduler.submit(req.thread_id, req)
+    except QueueFullError as e:
+        await dedup_store.forget(req.idempotency_key)
+        logger.warning(f"🚦 Rejecting request for thread {req.thread_id}: {e} (queue depth: {job_queue.depth}, busy workers: {job_queue.busy}/{job_queue.workers})")
+        raise HTTPException(
+            status_code=503 if e.closed else 429,
+            detail=str(e),
+            headers={"Retry-After": str(QUEUE_RETRY_AFTER)},
+        )
     return {"status": "ok", "message": "Processing started"}
 
 
-async def process_request(req: ChatRequest):
+async def process_request(req: ChatRequest, coalesced: list = None):
+    # Requests in `coalesced` arrived earlier on the same thread, their messages go into the same run
+    # and the reply is sent to the callback of `req`
+    messages = [earlier.message for earlier in coalesced or []] + [req.message]
+    # End-to-end time is measured from the oldest message answered by this callback
+    received_at = min(earlier._received_at for earlier in [*(coalesced or []), req])
     try:
         logger.info(f"🚀 Processing request for thread_id: {req.thread_id}")
-        gpt_response, open_ai_error = await stream_chat_completion(req.thread_id, req.asst_id, req.message)
+        gpt_response, open_ai_error = await stream_chat_completion(req.thread_id, req.asst_id, messages, timeout_limit=RUN_TIMEOUT)
 
-        callback_url = f"https://chatter.salebot.pro/api/{req.api_key}/callback"
+        callback_url = f"{CALLBACK_BASE_URL}/api/{req.api_key}/callback"
 
         if gpt_response is None or gpt_response.strip() == '':
             logger.error("⛔ No valid response from GPT, cannot send empty message.")
             open_ai_error = open_ai_error or "No valid response from GPT"
-            await send_callback(callback_url, req.api_key, req.client_id, "ChatGPT did not return a valid response", "error", open_ai_error, req.callback_text)
+            await send_callback(callback_url, req.api_key, req.client_id, "ChatGPT did not return a valid response", "error", open_ai_error, req.callback_text, received_at)
             return
 
         if gpt_response:
             logger.info(f"✅ GPT response: {gpt_response}")
-            await send_callback(callback_url, req.api_key, req.client_id, open_ai_text=gpt_response, open_ai_status="ok", callback_text=req.callback_text)
+            await send_callback(callback_url, req.api_key, req.client_id, open_ai_text=gpt_response, open_ai_status="ok", callback_text=req.callback_text, received_at=received_at)
+            return True
         else:
             logger.error(f"❌ Error: {open_ai_error}")
-            await send_callback(callback_url, req.api_key, req.client_id, open_ai_status="error", open_ai_error=open_ai_error, callback_text=req.callback_text)
+            await send_callback(callback_url, req.api_key, req.client_id, open_ai_status="error", open_ai_error=open_ai_error, callback_text=req.callback_text, received_at=received_at)
 
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
-        await send_callback(f"https://chatter.salebot.pro/api/{req.api_key}/callback", req.api_key, req.client_id, open_ai_status="error", open_ai_error=str(e), callback_text=req.callback_text)
-
+        await send_callback(f"{CALLBACK_BASE_URL}/api/{req.api_key}/callback", req.api_key, req.client_id, open_ai_status="error", open_ai_error=str(e), callback_text=req.callback_text, received_at=received_at)
+
+
+async def process_batch(thread_id: str, batch: list):
+    # A thread's job runs several batches, each is logged under the trace id of the request it answers
+    trace_id_var.set(batch[-1].trace_id)
+    if len(batch) > 1:
+        logger.info(f"🧩 Coalesced {len(batch)} messages into one run for thread {thread_id}")
+    # Time spent queued came out of the pending TTL, the run and its retries get a fresh one
+    for req in batch:
+        await dedup_store.hold(req.idempotency_key, 2 * RUN_TIMEOUT)
+    answered = await process_request(batch[-1], batch[:-1])
+    for req in batch:
+        # A request that failed may run again when its webhook is retried
+        if answered:
+            await dedup_store.complete(req.idempotency_key, req._dedup_window)
+        else:
+            await dedup_store.forget(req.idempotency_key)
+
+
+thread_scheduler = ThreadScheduler(
+    process_batch,
+    # The reply goes to the callback of the batch's last request, so only requests answered to the same place share a run
+    batch_key=lambda req: (req.asst_id, req.api_key, req.client_id),
+    max_batch=MAX_COALESCED_MESSAGES,
+    max_pending=THREAD_MAX_PENDING,
+    spawn=job_queue.submit,
+)
+
+metrics.gauge("job_queue_depth", "Jobs waiting for a worker", lambda: job_queue.depth)
+metrics.gauge("job_workers_busy", "Workers running a job", lambda: job_queue.busy)
+metrics.gauge("job_worker_utilisation", "Share of workers running a job", lambda: job_queue.utilisation)
+metrics.counter_from("job_queue_rejected_total", "Jobs rejected because the queue was full or closed", lambda: job_queue.stats["rejected"])
+metrics.gauge("thread_scheduler_active_threads", "Threads with a run queued or in progress", lambda: thread_scheduler.active_threads)
+metrics.gauge("thread_scheduler_pending_messages", "Messages waiting for their thread's next run", lambda: thread_scheduler.pending)
+metrics.counter_from("thread_scheduler_coalesced_total", "Messages merged into another message's run", lambda: thread_scheduler.stats["coalesced"])
+metrics.gauge("cluster_jobs", "Jobs queued or running across all workers sharing state_backend", lambda: cluster_jobs)
+metrics.gauge("callbacks_in_flight", "Callbacks being delivered or retried", lambda: callback_delivery.in_flight)
+metrics.counter_from("thread_cache_lookups_total", "Thread validation cache lookups", lambda: {
+    "hit": thread_cache.stats["hits"], "miss": thread_cache.stats["misses"],
+}, label="result")
+metrics.counter_from("dedup_requests_total", "Duplicate requests that did not start a run", lambda: dedup_store.stats["deduplicated"])
+metrics.counter_from("dedup_tokens_saved_total", "Estimated tokens saved by deduplication", lambda: dedup_store.stats["tokens_saved"])
+metrics.counter_from("rate_limiter_requests_total", "Requests passed through the rate limiter", lambda: {
+    "acquired": rate_limiter.stats["acquired"], "delayed": rate_limiter.stats["delayed"], "shed": rate_limiter.stats["shed"],
+}, label="result")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
-    import uvicorn
+    workers = int(os.getenv('WEB_WORKERS', 1))
+    if workers > 1:
+        from cluster import run_cluster
+
+        run_cluster(workers, host="0.0.0.0", port=8000)
+    else:
+        import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,27 +1,438 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
 import unittest
-from unittest.mock import patch, Mock
-from main import send_callback
+from types import SimpleNamespace
+from unittest import mock
 
-class TestSendCallback(unittest.TestCase):
-    def test_send_callback_with_empty_messages(self):
+import httpx
+import openai
+
+os.environ.setdefault("GPT_TOKEN", "test-token")
+
+import main
+from callback_delivery import CallbackDelivery
+from rate_limit import RateLimiter
+from state import AsyncBackend, MemoryBackend
+from ttl_cache import TTLCache
+
+
+def event(name, **data):
+    return SimpleNamespace(event=name, data=SimpleNamespace(**data))
+
+
+def message(text):
+    return SimpleNamespace(content=[SimpleNamespace(text=SimpleNamespace(value=text))])
+
+
+class FakeStream:
+    def __init__(self, events, error=None, hang=False):
+        self.events = events
+        self.error = error
+        self.hang = hang
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for item in self.events:
+            yield item
+        if self.error is not None:
+            raise self.error
+        if self.hang:
+            await asyncio.Event().wait()
+
+
+class FakeClient:
+    """Stands in for AsyncOpenAI, recording the calls made to the Assistants API."""
+
+    def __init__(self, stream=None, statuses=(), reply="Hi", thread_error=None, create_error=None):
+        self.stream = stream
+        self.create_error = create_error
+        self.statuses = list(statuses)
+        self.reply = reply
+        self.thread_error = thread_error
+        self.calls = []
+        runs = SimpleNamespace(
+            with_raw_response=SimpleNamespace(create=self.create_run), retrieve=self.retrieve_run, cancel=self.cancel_run,
+        )
+        threads = SimpleNamespace(runs=runs, messages=SimpleNamespace(list=self.list_messages), retrieve=self.retrieve_thread)
+        self.beta = SimpleNamespace(threads=threads)
+
+    def with_options(self, **options):
+        self.calls.append(("with_options", options))
+        return self
+
+    async def create_run(self, **kwargs):
+        self.calls.append(("runs.create", kwargs))
+        if self.create_error is not None:
+            raise self.create_error
+        parsed = self.stream if kwargs.get("stream") else SimpleNamespace(id="run_polled")
+        return SimpleNamespace(headers={}, parse=lambda: parsed)
+
+    async def retrieve_run(self, **kwargs):
+        self.calls.append(("runs.retrieve", kwargs))
+        return SimpleNamespace(id=kwargs["run_id"], status=self.statuses.pop(0), usage=None, last_error=None)
+
+    async def cancel_run(self, **kwargs):
+        self.calls.append(("runs.cancel", kwargs))
+
+    async def list_messages(self, **kwargs):
+        self.calls.append(("messages.list", kwargs))
+        return SimpleNamespace(data=[message(self.reply)])
+
+    async def retrieve_thread(self, **kwargs):
+        self.calls.append(("threads.retrieve", kwargs))
+        if self.thread_error is not None:
+            raise self.thread_error
+
+    def called(self, name):
+        return [kwargs for call, kwargs in self.calls if call == name]
+
+
+class TestSendCallback(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        self.statuses = []
+
+        def handler(request):
+            self.requests.append(request)
+            return httpx.Response(self.statuses.pop(0) if self.statuses else 200)
+
+        self.original_delivery = main.callback_delivery
+        main.callback_delivery = CallbackDelivery(base_delay=0, transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        await main.callback_delivery.aclose()
+        main.callback_delivery = self.original_delivery
+
+    async def test_send_callback_with_response(self):
         callback_url = "https://example.com/callback"
         sale_token = "example-sale-token"
-        client_id = "example-client-id"
-        messages = []
+        client_id = 42
+
+        result = await (await main.send_callback(callback_url, sale_token, client_id, open_ai_text="Hi", open_ai_status="ok", callback_text="text"))
+
+        self.assertEqual(result.outcome, "ok")
+        self.assertEqual(str(self.requests[0].url), callback_url)
+        self.assertEqual(self.requests[0].headers["Authorization"], f"Bearer {sale_token}")
+        self.assertEqual(json.loads(self.requests[0].read()), {
+            "message": "text",
+            "client_id": client_id,
+            "open_ai_status": "ok",
+            "open_ai_text": "Hi",
+        })
+
+    async def test_send_callback_falls_back_to_error_payload(self):
+        self.statuses = [404]
+
+        result = await (await main.send_callback("https://example.com/callback", "token", 1, open_ai_text="Hi", open_ai_status="ok", callback_text="text"))
+
+        self.assertEqual(result.outcome, "fallback")
+        fallback = json.loads(self.requests[1].read())
+        self.assertEqual(fallback["open_ai_status"], "error")
+        self.assertIn("Callback failed due to", fallback["open_ai_error"])
+
+
+class TestChatEndpoint(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.submitted = []
+        self.original_submit = main.thread_scheduler.submit
+        self.original_store = main.dedup_store
+        main.thread_scheduler.submit = lambda thread_id, req: self.submitted.append(req)
+        main.dedup_store = main.DedupStore()
+
+    async def asyncTearDown(self):
+        main.thread_scheduler.submit = self.original_submit
+        main.dedup_store = self.original_store
+
+    def make_request(self, **fields):
+        return main.ChatRequest(**{
+            "thread_id": "thread_1", "asst_id": "asst_1", "api_key": "key", "client_id": 1,
+            "message": "Hello", "callback_text": "text", **fields,
+        })
+
+    async def test_duplicate_request_does_not_start_a_run(self):
+        first = await main.chat_endpoint(self.make_request(), idempotency_key=None, x_trace_id=None)
+        second = await main.chat_endpoint(self.make_request(), idempotency_key=None, x_trace_id=None)
+
+        self.assertEqual(len(self.submitted), 1)
+        self.assertEqual(first, second)
+        self.assertEqual(main.dedup_store.stats["deduplicated"], 1)
+
+    async def test_repeated_message_is_only_deduplicated_briefly(self):
+        with mock.patch.object(main, "DEDUP_CONTENT_WINDOW", 0), mock.patch.object(main, "process_request", mock.AsyncMock(return_value=True)):
+            await main.chat_endpoint(self.make_request(message="ok"), idempotency_key=None, x_trace_id=None)
+            await main.chat_endpoint(self.make_request(message="ok", callback_text="other"), idempotency_key="webhook-1", x_trace_id=None)
+            await main.process_batch("thread_1", self.submitted[:1])
+            await main.process_batch("thread_1", self.submitted[1:])
+
+            await main.chat_endpoint(self.make_request(message="ok"), idempotency_key=None, x_trace_id=None)
+            await main.chat_endpoint(self.make_request(message="ok", callback_text="other"), idempotency_key="webhook-1", x_trace_id=None)
+
+        # The content-hashed key expired, the explicit one is kept for DEDUP_WINDOW
+        self.assertEqual(len(self.submitted), 3)
+
+    async def test_batches_only_requests_answered_to_the_same_callback(self):
+        batch_key = main.thread_scheduler.batch_key
+
+        self.assertEqual(batch_key(self.make_request()), batch_key(self.make_request(message="Again")))
+        self.assertNotEqual(batch_key(self.make_request()), batch_key(self.make_request(client_id=2)))
+        self.assertNotEqual(batch_key(self.make_request()), batch_key(self.make_request(api_key="other")))
+
+    async def test_misrouted_request_returns_421(self):
+        owner = main.owner_of("thread_1", 2)
+
+        with mock.patch.object(main, "WORKER_COUNT", 2), mock.patch.object(main, "WORKER_INDEX", 1 - owner):
+            with self.assertRaises(main.HTTPException) as context:
+                await main.chat_endpoint(self.make_request(), idempotency_key=None, x_trace_id=None)
+        self.assertEqual(context.exception.status_code, 421)
+        self.assertEqual(self.submitted, [])
+
+        with mock.patch.object(main, "WORKER_COUNT", 2), mock.patch.object(main, "WORKER_INDEX", owner):
+            await main.chat_endpoint(self.make_request(), idempotency_key=None, x_trace_id=None)
+        self.assertEqual(len(self.submitted), 1)
+
+    async def test_saturated_queue_returns_429(self):
+        def reject(thread_id, req):
+            raise main.QueueFullError("full")
+
+        main.thread_scheduler.submit = reject
+
+        with self.assertRaises(main.HTTPException) as context:
+            await main.chat_endpoint(self.make_request(), idempotency_key=None, x_trace_id=None)
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertIn("Retry-After", context.exception.headers)
+
+
+class TestRunCompletion(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.original = main.client, main.rate_limiter
+        main.rate_limiter = RateLimiter(rpm=10000, tpm=10000000)
+
+    async def asyncTearDown(self):
+        main.client, main.rate_limiter = self.original
+
+    def stats(self):
+        return {"api_calls": 0, "polls": 0, "run_id": None, "estimated_tokens": 0, "usage": None}
+
+    async def test_stream_returns_completed_message(self):
+        main.client = FakeClient(stream=FakeStream([
+            event("thread.run.created", id="run_1"),
+            event("thread.message.completed", content=message(" Hello ").content),
+            event("thread.run.completed", id="run_1", usage="usage"),
+        ]))
+        stats = self.stats()
+
+        text = await main.stream_run("thread_1", "asst_1", ["Hi"], stats)
+
+        self.assertEqual(text, "Hello")
+        self.assertEqual(stats["run_id"], "run_1")
+        self.assertEqual(stats["usage"], "usage")
+        self.assertEqual(main.client.called("runs.create")[0]["additional_messages"], [{"role": "user", "content": "Hi"}])
+        self.assertEqual(main.client.called("with_options"), [{"max_retries": 0}])
+
+    async def test_terminal_event_raises_run_failed(self):
+        main.client = FakeClient(stream=FakeStream([
+            event("thread.run.created", id="run_1"),
+            event("thread.run.failed", id="run_1", status="failed", last_error=SimpleNamespace(message="boom")),
+        ]))
+
+        with self.assertRaises(main.RunFailedError) as context:
+            await main.run_to_completion("thread_1", "asst_1", ["Hi"], self.stats())
+        self.assertIn("boom", str(context.exception))
+        self.assertEqual(main.client.called("runs.retrieve"), [])
+
+    async def test_broken_stream_falls_back_to_polling_same_run(self):
+        main.client = FakeClient(
+            stream=FakeStream([event("thread.run.created", id="run_1")], error=httpx.ReadError("connection lost")),
+            statuses=["completed"],
+            reply="Polled",
+        )
+        stats = self.stats()
+
+        with mock.patch.object(main, "POLL_INITIAL_INTERVAL", 0):
+            text = await main.run_to_completion("thread_1", "asst_1", ["Hi"], stats)
+
+        self.assertEqual(text, "Polled")
+        self.assertEqual(len(main.client.called("runs.create")), 1)
+        self.assertEqual(main.client.called("runs.retrieve")[0]["run_id"], "run_1")
+
+    async def test_stream_failing_before_run_starts_creates_a_polled_run(self):
+        main.client = FakeClient(stream=FakeStream([], error=httpx.ReadError("connection lost")), statuses=["completed"])
+
+        with mock.patch.object(main, "POLL_INITIAL_INTERVAL", 0):
+            await main.run_to_completion("thread_1", "asst_1", ["Hi"], self.stats())
+
+        self.assertEqual([kwargs.get("stream") for kwargs in main.client.called("runs.create")], [True, None])
+        self.assertEqual(main.client.called("runs.retrieve")[0]["run_id"], "run_polled")
+
+    async def test_failed_create_is_not_repeated_as_a_polled_run(self):
+        request = httpx.Request("POST", "https://api.openai.com/v1/threads/thread_1/runs")
+        main.client = FakeClient(create_error=openai.BadRequestError(
+            "Thread thread_1 already has an active run", response=httpx.Response(400, request=request), body=None,
+        ))
+        acquire = mock.AsyncMock(return_value=0)
+
+        with mock.patch.object(main.rate_limiter, "acquire", acquire), mock.patch("asyncio.sleep", new=mock.AsyncMock()):
+            text, error = await main.stream_chat_completion("thread_1", "asst_1", "Hi")
+
+        self.assertEqual(text, "")
+        self.assertIn("active run", error)
+        self.assertEqual(len(main.client.called("runs.create")), 3)
+        self.assertEqual(acquire.await_count, 3)
+
+    async def test_timeout_cancels_run_and_stops_retrying(self):
+        main.client = FakeClient(stream=FakeStream([event("thread.run.created", id="run_1")], hang=True))
+
+        text, error = await main.stream_chat_completion("thread_1", "asst_1", "Hi", timeout_limit=0.1)
+
+        self.assertEqual(text, "")
+        self.assertIn("Timed out", error)
+        self.assertEqual(len(main.client.called("runs.create")), 1)
+        self.assertEqual([kwargs["run_id"] for kwargs in main.client.called("runs.cancel")], ["run_1"])
+
+    async def test_run_requiring_action_is_cancelled(self):
+        main.client = FakeClient(stream=FakeStream([
+            event("thread.run.created", id="run_1"),
+            event("thread.run.requires_action", id="run_1", status="requires_action", last_error=None),
+        ]))
+
+        with self.assertRaises(main.RunFailedError):
+            await main.stream_run("thread_1", "asst_1", ["Hi"], self.stats())
+        self.assertEqual([kwargs["run_id"] for kwargs in main.client.called("runs.cancel")], ["run_1"])
+
+        main.client = FakeClient(statuses=["requires_action"])
+        with self.assertRaises(main.RunFailedError):
+            await main.poll_run("thread_1", "run_2", self.stats())
+        self.assertEqual([kwargs["run_id"] for kwargs in main.client.called("runs.cancel")], ["run_2"])
+
+    async def test_polling_backs_off(self):
+        main.client = FakeClient(statuses=["queued", "in_progress", "in_progress", "in_progress", "completed"])
+        stats = self.stats()
+
+        with mock.patch.object(main, "POLL_INITIAL_INTERVAL", 1), mock.patch.object(main, "POLL_BACKOFF", 2), \
+                mock.patch.object(main, "POLL_MAX_INTERVAL", 5), mock.patch("asyncio.sleep", new=mock.AsyncMock()) as sleep:
+            text = await main.poll_run("thread_1", "run_1", stats)
+
+        self.assertEqual(text, "Hi")
+        self.assertEqual([call.args[0] for call in sleep.await_args_list], [1, 2, 4, 5])
+        self.assertEqual(stats["polls"], 5)
+        self.assertEqual(main.client.called("messages.list"), [{"thread_id": "thread_1", "run_id": "run_1", "limit": 1, "order": "desc"}])
+
+    async def test_polled_terminal_status_raises_run_failed(self):
+        main.client = FakeClient(statuses=["expired"])
+
+        with self.assertRaises(main.RunFailedError):
+            await main.poll_run("thread_1", "run_1", self.stats())
+        self.assertEqual(main.client.called("messages.list"), [])
+
+
+class TestValidateThread(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.original = main.client, main.thread_cache, main.state_backend
+        main.thread_cache = TTLCache()
+        main.state_backend = AsyncBackend(MemoryBackend())
+
+    async def asyncTearDown(self):
+        main.client, main.thread_cache, main.state_backend = self.original
+
+    def not_found(self):
+        request = httpx.Request("GET", "https://api.openai.com/v1/threads/thread_1")
+        return openai.NotFoundError("No thread found", response=httpx.Response(404, request=request), body=None)
+
+    async def test_repeat_turn_skips_retrieve(self):
+        main.client = FakeClient()
+
+        self.assertIsNone(await main.validate_thread("thread_1"))
+        self.assertIsNone(await main.validate_thread("thread_1"))
+        self.assertEqual(len(main.client.called("threads.retrieve")), 1)
+
+    async def test_not_found_is_cached_briefly(self):
+        main.client = FakeClient(thread_error=self.not_found())
+
+        with mock.patch.object(main, "THREAD_NOT_FOUND_TTL", 0.05):
+            self.assertIn("No thread found", await main.validate_thread("thread_1"))
+            self.assertIn("No thread found", await main.validate_thread("thread_1"))
+            self.assertEqual(len(main.client.called("threads.retrieve")), 1)
+
+            await asyncio.sleep(0.06)
+            main.client.thread_error = None
+            self.assertIsNone(await main.validate_thread("thread_1"))
+        self.assertEqual(len(main.client.called("threads.retrieve")), 2)
+
+    async def test_transient_error_is_not_cached(self):
+        main.client = FakeClient(thread_error=openai.APIConnectionError(request=httpx.Request("GET", "https://api.openai.com")))
+
+        self.assertIsNotNone(await main.validate_thread("thread_1"))
+        main.client.thread_error = None
+        self.assertIsNone(await main.validate_thread("thread_1"))
+        self.assertEqual(len(main.client.called("threads.retrieve")), 2)
+
+    async def test_result_is_shared_through_state_backend(self):
+        main.client = FakeClient()
+        await main.validate_thread("thread_1")
+        # Another worker, or this one after a restart
+        main.thread_cache = TTLCache()
+
+        self.assertIsNone(await main.validate_thread("thread_1"))
+        self.assertEqual(len(main.client.called("threads.retrieve")), 1)
+
+
+class TestObservability(unittest.IsolatedAsyncioTestCase):
+    def make_request(self, trace_id):
+        return main.ChatRequest(
+            thread_id="thread_1", asst_id="asst_1", api_key="key", client_id=1,
+            message="Hello", callback_text="text", idempotency_key=trace_id, trace_id=trace_id,
+        )
+
+    def test_trace_id_filter_tags_records(self):
+        def tag():
+            record = logging.LogRecord("main", logging.INFO, __file__, 0, "message", None, None)
+            main.TraceIdFilter().filter(record)
+            return record.trace_id
+
+        self.assertEqual(contextvars.Context().run(tag), "")
+        context = contextvars.Context()
+        context.run(main.trace_id_var.set, "abc123")
+        self.assertEqual(context.run(tag), "[abc123] ")
+
+    async def test_batch_is_logged_under_its_own_trace_id(self):
+        records = []
+        handler = logging.Handler()
+        handler.addFilter(main.TraceIdFilter())
+        handler.emit = records.append
+        main.logger.addHandler(handler)
+        self.addCleanup(main.logger.removeHandler, handler)
+        seen = []
+
+        async def process_request(req, coalesced):
+            seen.append(main.trace_id_var.get())
+            return True
+
+        # Left over from an earlier job on the same worker
+        main.trace_id_var.set("stale")
+        with mock.patch.object(main, "process_request", process_request):
+            await main.process_batch("thread_1", [self.make_request("trace-1"), self.make_request("trace-2")])
 
-        mock_response = Mock()
-        mock_response.raise_for_status.return_value = None
+        self.assertEqual(seen, ["trace-2"])
+        coalesced = [record for record in records if "Coalesced" in record.getMessage()]
+        self.assertEqual([record.trace_id for record in coalesced], ["[trace-2] "])
 
-        with patch("requests.post") as mock_post:
-            mock_post.return_value = mock_response
+    async def test_metrics_endpoint(self):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://app") as http:
+            response = await http.get("/metrics")
 
-            send_callback(callback_url, sale_token, client_id, messages)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn("# TYPE job_queue_depth gauge", response.text)
+        self.assertIn("chat_stage_seconds", response.text)
 
-            mock_post.assert_called_once_with(
-                callback_url,
-                json={"client_id": client_id, "messages": messages},
-                headers={"Authorization": f"Bearer {sale_token}", "Content-Type": "application/json"},
-            )
 
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
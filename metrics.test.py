@@ -0,0 +1,45 @@
+import unittest
+
+from metrics import Registry
+
+
+class TestRegistry(unittest.TestCase):
+    def test_renders_counters_and_gauges(self):
+        registry = Registry()
+        callbacks = registry.counter("callbacks_total", "Callbacks by outcome")
+        callbacks.inc(outcome="ok")
+        callbacks.inc(outcome="ok")
+        registry.gauge("queue_depth", "Queued jobs", lambda: 3)
+        registry.counter_from("cache_total", "Cache lookups", lambda: {"hit": 2}, label="result")
+
+        text = registry.render()
+
+        self.assertIn("# TYPE callbacks_total counter\n", text)
+        self.assertIn('callbacks_total{outcome="ok"} 2\n', text)
+        self.assertIn("queue_depth 3\n", text)
+        self.assertIn('cache_total{result="hit"} 2\n', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Registry()
+        stages = registry.histogram("stage_seconds", "Stage latency", buckets=(0.1, 1))
+        stages.observe(0.05, stage="create")
+        stages.observe(0.5, stage="create")
+        stages.observe(5, stage="create")
+
+        text = registry.render()
+
+        self.assertIn('stage_seconds_bucket{le="0.1",stage="create"} 1\n', text)
+        self.assertIn('stage_seconds_bucket{le="1",stage="create"} 2\n', text)
+        self.assertIn('stage_seconds_bucket{le="+Inf",stage="create"} 3\n', text)
+        self.assertIn('stage_seconds_count{stage="create"} 3\n', text)
+        self.assertEqual(stages.count(stage="create"), 3)
+
+    def test_escapes_label_values(self):
+        registry = Registry()
+        registry.counter("errors_total", "Errors").inc(error='bad "quote"')
+
+        self.assertIn('errors_total{error="bad \\"quote\\""} 1\n', registry.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+import asyncio
+import itertools
+import logging
+import re
+import time
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# How long each priority may wait for budget (as a multiple of max_wait) before it is shed
+PRIORITY_MAX_WAIT_FACTOR = {PRIORITY_HIGH: 2.0, PRIORITY_NORMAL: 1.0, PRIORITY_LOW: 0.25}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+_encodings = {}
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message: str, wait: float):
+        super().__init__(message)
+        self.wait = wait
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parses OpenAI reset durations such as "1s", "6m0s" or "20ms" into seconds."""
+    parts = _DURATION_PART.findall(value or "")
+    if not parts:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def load_encoding(model: str = "gpt-4o-mini") -> None:
+    """Loads the tiktoken encoding for ``model``. Blocks while tiktoken downloads it on first use, so run it off the event loop."""
+    try:
+        import tiktoken
+        _encodings[model] = tiktoken.encoding_for_model(model)
+    except Exception as e:
+        logger.warning(f"⚠️ tiktoken encoding for {model} unavailable, estimating tokens from length: {e}")
+        _encodings[model] = None
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    # Falls back to ~4 characters per token until load_encoding has run, or if it failed
+    encoding = _encodings.get(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    # User text may contain special tokens such as <|endoftext|>, they are counted like any other text
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # A request larger than the whole bucket only has to wait for a full one
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing, 0) / self.rate if self.rate else float("inf")
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def sync(self, limit: Optional[float], remaining: Optional[float]) -> None:
+        self._refill()
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute budgets.
+
+    Budgets start from the configured limits and follow the ``x-ratelimit-*``
+    and ``retry-after`` headers of API responses. ``acquire`` waits until the
+    budget allows a request or sheds it when the wait would be too long for its
+    priority.
+
+    ``share`` is the fraction of the account's limits this limiter may use, e.g.
+    1/N for each of N worker processes.
+    """
+
+    def __init__(self, rpm: float, tpm: float, max_wait: float = 10.0, share: float = 1.0):
+        self.share = share
+        self.requests = TokenBucket(rpm * share)
+        self.tokens = TokenBucket(tpm * share)
+        self.max_wait = max_wait
+        self.paused_until = 0.0
+        # (priority, arrival, tokens) of every request waiting for budget
+        self._waiters: list = []
+        self._arrivals = itertools.count()
+        self._changed = asyncio.Event()
+        self.stats = {"acquired": 0, "delayed": 0, "shed": 0, "wait_seconds": 0.0}
+
+    def _notify(self) -> None:
+        # Wakes every waiter to re-check its place in line and the budget
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _wait_time(self, requests: int, tokens: int) -> float:
+        return max(
+            self.requests.wait_time(requests),
+            self.tokens.wait_time(tokens),
+            self.paused_until - time.monotonic(),
+            0,
+        )
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL) -> float:
+        """Reserves one request and ``tokens`` tokens. Returns the seconds waited.
+
+        Waiters are served by priority, then in arrival order. A request is shed
+        as soon as the budget it and the waiters ahead of it need can't be
+        available within the max wait of its priority, counted from the call.
+        """
+        max_wait = self.max_wait * PRIORITY_MAX_WAIT_FACTOR.get(priority, 1.0)
+        entered = time.monotonic()
+        slept = False
+        waiter = (priority, next(self._arrivals), tokens)
+        self._waiters.append(waiter)
+        self._notify()
+        try:
+            while True:
+                ahead = [other for other in self._waiters if other < waiter]
+                wait = self._wait_time(len(ahead) + 1, tokens + sum(other[2] for other in ahead))
+                if not ahead and wait <= 0:
+                    break
+                if time.monotonic() - entered + wait > max_wait:
+                    self.stats["shed"] += 1
+                    raise RateLimitExceeded(f"Rate limit budget exhausted, request would wait {wait:.1f}s", wait)
+                changed = self._changed
+                slept = True
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=wait or None)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+        finally:
+            self._waiters.remove(waiter)
+            self._notify()
+
+        waited = time.monotonic() - entered if slept else 0.0
+        self.stats["acquired"] += 1
+        if waited:
+            self.stats["delayed"] += 1
+            self.stats["wait_seconds"] += waited
+            logger.info(f"🚦 Delayed request {waited:.2f}s for rate limit budget ({tokens} tokens)")
+        return waited
+
+    def settle(self, estimated: int, actual: int) -> None:
+        # Corrects the token budget once the real usage of a run is known
+        self.tokens.consume(actual - estimated)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        def number(name):
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        def share(name):
+            value = number(name)
+            return value * self.share if value is not None else None
+
+        self.requests.sync(share("x-ratelimit-limit-requests"), share("x-ratelimit-remaining-requests"))
+        self.tokens.sync(share("x-ratelimit-limit-tokens"), share("x-ratelimit-remaining-tokens"))
+
+        retry_after = number("retry-after-ms")
+        retry_after = retry_after / 1000 if retry_after is not None else parse_duration(headers.get("retry-after"))
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            logger.warning(f"⏸️ API asked to retry after {retry_after:.2f}s, pausing requests")
+        self._notify()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import rate_limit
+from rate_limit import RateLimiter, RateLimitExceeded, count_tokens, parse_duration, PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_acquires_within_budget(self):
+        limiter = RateLimiter(rpm=60, tpm=1000)
+
+        self.assertEqual(await limiter.acquire(100), 0)
+        self.assertEqual(limiter.stats["acquired"], 1)
+        self.assertAlmostEqual(limiter.tokens.tokens, 900, delta=1)
+
+    async def test_delays_until_budget_refills(self):
+        limiter = RateLimiter(rpm=6000, tpm=6000)
+        limiter.tokens.tokens = 0
+
+        waited = await limiter.acquire(1)
+
+        self.assertGreater(waited, 0)
+        self.assertEqual(limiter.stats["delayed"], 1)
+
+    async def test_sheds_low_priority_first(self):
+        limiter = RateLimiter(rpm=60, tpm=60, max_wait=2)
+        limiter.tokens.tokens = 0
+
+        with self.assertRaises(RateLimitExceeded):
+            await limiter.acquire(1, PRIORITY_LOW)
+        self.assertEqual(limiter.stats["shed"], 1)
+        self.assertGreater(await limiter.acquire(1, PRIORITY_HIGH), 0)
+
+    async def test_serves_concurrent_waiters_by_priority_within_max_wait(self):
+        # One request per 0.1s, a normal request may wait 0.25s and a high priority one 0.5s
+        limiter = RateLimiter(rpm=600, tpm=100000, max_wait=0.25)
+        limiter.requests.tokens = 0
+        admitted = []
+
+        async def request(name, priority):
+            try:
+                await limiter.acquire(1, priority)
+                admitted.append(name)
+            except RateLimitExceeded:
+                admitted.append(f"{name} shed")
+
+        tasks = [asyncio.create_task(request(f"normal {i}", PRIORITY_NORMAL)) for i in range(5)]
+        tasks.append(asyncio.create_task(request("high", PRIORITY_HIGH)))
+        await asyncio.gather(*tasks)
+
+        # Normal 2-4 can't be served within 0.25s, normal 1 is pushed past it once the high priority request arrives
+        self.assertEqual(admitted[:4], ["normal 2 shed", "normal 3 shed", "normal 4 shed", "normal 1 shed"])
+        self.assertEqual(admitted[4:], ["high", "normal 0"])
+        self.assertEqual(limiter.stats["shed"], 4)
+
+    async def test_follows_response_headers(self):
+        limiter = RateLimiter(rpm=500, tpm=100000, max_wait=0.5)
+        limiter.update_from_headers({
+            "x-ratelimit-limit-requests": "100",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-limit-tokens": "20000",
+            "x-ratelimit-remaining-tokens": "15000",
+        })
+
+        self.assertEqual(limiter.requests.capacity, 100)
+        self.assertAlmostEqual(limiter.tokens.tokens, 15000, delta=1)
+        with self.assertRaises(RateLimitExceeded):
+            await limiter.acquire(1)
+
+    async def test_share_scales_limits(self):
+        limiter = RateLimiter(rpm=600, tpm=100000, share=0.5)
+        limiter.update_from_headers({"x-ratelimit-limit-requests": "1000", "x-ratelimit-remaining-requests": "100"})
+
+        self.assertEqual(limiter.requests.capacity, 500)
+        self.assertAlmostEqual(limiter.requests.tokens, 50, delta=1)
+        self.assertEqual(limiter.tokens.capacity, 50000)
+
+    async def test_retry_after_pauses_requests(self):
+        limiter = RateLimiter(rpm=500, tpm=100000, max_wait=5)
+        limiter.update_from_headers({"retry-after": "30"})
+
+        with self.assertRaises(RateLimitExceeded) as context:
+            await limiter.acquire(1)
+        self.assertGreater(context.exception.wait, 29)
+
+    def test_count_tokens_estimates_until_encoding_is_loaded(self):
+        self.assertEqual(count_tokens("x" * 40, model="not-loaded"), 11)
+
+    def test_count_tokens_accepts_special_tokens_in_text(self):
+        import tiktoken
+
+        encoding = tiktoken.Encoding(
+            name="bytes",
+            pat_str=r"\S+|\s+",
+            mergeable_ranks={bytes([i]): i for i in range(256)},
+            special_tokens={"<|endoftext|>": 256},
+        )
+        with mock.patch.dict(rate_limit._encodings, {"bytes": encoding}):
+            self.assertEqual(count_tokens("hi <|endoftext|>", model="bytes"), 16)
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration("6m0s"), 360)
+        self.assertEqual(parse_duration("20ms"), 0.02)
+        self.assertEqual(parse_duration("1.5"), 1.5)
+        self.assertIsNone(parse_duration("soon"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from ttl_cache import TTLCache
+
+
+class MemoryBackend:
+    """Key/value state kept in this process. Values expire after their ``ttl`` and must not be None."""
+
+    blocking = False
+
+    def __init__(self, maxsize: int = 100000):
+        self._cache = TTLCache(maxsize=maxsize, ttl=float("inf"))
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._cache.set(key, value, ttl=ttl)
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        """Sets ``key`` only if it is not set yet. Returns True if it was added."""
+        if self._cache.get(key) is not None:
+            return False
+        self._cache.set(key, value, ttl=ttl)
+        return True
+
+    def delete(self, key: str) -> None:
+        self._cache.delete(key)
+
+    def items(self, prefix: str) -> dict:
+        return {key: value for key, value in self._cache.items() if key.startswith(prefix)}
+
+
+class SQLiteBackend:
+    """Key/value state in a SQLite file, shared by every process on the host and kept across restarts.
+
+    Calls block on disk and on other processes holding the write lock, use it through AsyncBackend.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._writes = 0
+        # The connection is used from AsyncBackend's worker threads, one call at a time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _written(self) -> None:
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._db.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+            self._db.execute(
+                "DELETE FROM state WHERE key IN (SELECT key FROM state ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl),
+            )
+            self._written()
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # Expired rows are replaced, live ones are left alone; the upsert makes this atomic across processes
+            added = self._db.execute(
+                "INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE state.expires_at <= ?",
+                (key, json.dumps(value), now + ttl, now),
+            ).rowcount
+            self._written()
+        return bool(added)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def items(self, prefix: str) -> dict:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, value FROM state WHERE key >= ? AND key < ? AND expires_at > ?",
+                (prefix, prefix + "\uffff", time.time()),
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+
+class AsyncBackend:
+    """Awaitable access to a backend, calls to a ``blocking`` one run in a worker thread off the event loop."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def _call(self, method: str, *args):
+        function = getattr(self.backend, method)
+        if self.backend.blocking:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await self._call("get", key)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        await self._call("set", key, value, ttl)
+
+    async def add(self, key: str, value: Any, ttl: float) -> bool:
+        return await self._call("add", key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self._call("delete", key)
+
+    async def items(self, prefix: str) -> dict:
+        return await self._call("items", prefix)
+
+
+def create_backend(url: str) -> AsyncBackend:
+    """Creates a backend from ``memory://`` or ``sqlite:///path/to/state.db``."""
+    if not url or url == "memory://":
+        return AsyncBackend(MemoryBackend())
+    if url.startswith("sqlite:///"):
+        return AsyncBackend(SQLiteBackend(url[len("sqlite:///"):]))
+    raise ValueError(f"Unsupported state backend: {url}")
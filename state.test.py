@@ -0,0 +1,96 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from state import AsyncBackend, MemoryBackend, SQLiteBackend, create_backend
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def backends(self):
+        # Every case runs against each backend, they must behave the same
+        for backend in (MemoryBackend(), SQLiteBackend(self.path)):
+            with self.subTest(backend=type(backend).__name__):
+                yield backend
+
+    def test_set_and_get(self):
+        for backend in self.backends():
+            backend.set("key", {"value": 1}, ttl=60)
+
+            self.assertEqual(backend.get("key"), {"value": 1})
+            self.assertIsNone(backend.get("missing"))
+
+    def test_values_expire(self):
+        for backend in self.backends():
+            backend.set("key", "value", ttl=0.05)
+            time.sleep(0.06)
+
+            self.assertIsNone(backend.get("key"))
+
+    def test_add_only_sets_missing_or_expired_keys(self):
+        for backend in self.backends():
+            self.assertTrue(backend.add("key", "first", ttl=0.05))
+            self.assertFalse(backend.add("key", "second", ttl=60))
+            self.assertEqual(backend.get("key"), "first")
+            time.sleep(0.06)
+            self.assertTrue(backend.add("key", "third", ttl=60))
+            self.assertEqual(backend.get("key"), "third")
+
+    def test_delete(self):
+        for backend in self.backends():
+            backend.set("key", "value", ttl=60)
+            backend.delete("key")
+
+            self.assertIsNone(backend.get("key"))
+
+    def test_items_by_prefix(self):
+        for backend in self.backends():
+            backend.set("queue_depth:0", 3, ttl=60)
+            backend.set("queue_depth:1", 4, ttl=60)
+            backend.set("queue_depth:2", 5, ttl=0)
+            backend.set("queue_depth_total", 1, ttl=60)
+            backend.set("thread:queue_depth:0", 1, ttl=60)
+
+            self.assertEqual(backend.items("queue_depth:"), {"queue_depth:0": 3, "queue_depth:1": 4})
+
+    def test_sqlite_state_is_shared_between_connections(self):
+        SQLiteBackend(self.path).set("key", "value", ttl=60)
+
+        self.assertEqual(SQLiteBackend(self.path).get("key"), "value")
+        self.assertFalse(SQLiteBackend(self.path).add("key", "other", ttl=60))
+
+
+class TestCreateBackend(unittest.IsolatedAsyncioTestCase):
+    async def test_urls(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsInstance(create_backend("memory://").backend, MemoryBackend)
+            self.assertIsInstance(create_backend("").backend, MemoryBackend)
+            sqlite = create_backend(f"sqlite:///{os.path.join(directory, 'state.sqlite')}")
+            self.assertIsInstance(sqlite.backend, SQLiteBackend)
+            await sqlite.set("key", "value", 60)
+            self.assertEqual(await sqlite.items("k"), {"key": "value"})
+
+        with self.assertRaises(ValueError):
+            create_backend("redis://localhost")
+
+    async def test_blocking_backend_runs_off_the_event_loop(self):
+        class RecordingBackend(MemoryBackend):
+            blocking = True
+
+            def get(self, key):
+                return threading.get_ident()
+
+        self.assertNotEqual(await AsyncBackend(RecordingBackend()).get("key"), threading.get_ident())
+        self.assertEqual(await AsyncBackend(MemoryBackend()).get("key"), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
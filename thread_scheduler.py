@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from job_queue import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadScheduler:
+    """Runs work one batch at a time per thread_id.
+
+    Items submitted while a thread is busy are queued and handed to the next
+    ``handler(thread_id, batch)`` call together, so a burst of messages becomes a
+    single run. ``batch_key(item)`` decides which queued items may share a batch.
+    A thread's queue is dropped as soon as it has nothing left to do.
+
+    ``spawn(job)`` starts a thread's worker, by default as a plain task; pass
+    ``JobQueue.submit`` to run threads on a bounded worker pool instead.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, list], Awaitable[Any]],
+        batch_key: Callable[[Any], Hashable] = lambda item: None,
+        max_batch: int = 10,
+        max_pending: int = 50,
+        spawn: Optional[Callable[[Callable[[], Awaitable]], Awaitable]] = None,
+    ):
+        self.handler = handler
+        self.batch_key = batch_key
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.spawn = spawn or (lambda job: asyncio.ensure_future(job()))
+        self._pending: dict[str, list] = {}
+        self._workers: dict[str, Awaitable] = {}
+        self.stats = {"submitted": 0, "batches": 0, "coalesced": 0}
+
+    @property
+    def active_threads(self) -> int:
+        return len(self._workers)
+
+    @property
+    def pending(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    def submit(self, thread_id: str, item) -> None:
+        """Queues ``item`` for ``thread_id``. Raises QueueFullError if it cannot be accepted."""
+        pending = self._pending.setdefault(thread_id, [])
+        if thread_id in self._workers:
+            if len(pending) >= self.max_pending:
+                raise QueueFullError(f"Thread {thread_id} already has {len(pending)} pending messages")
+            pending.append(item)
+            logger.info(f"📥 Thread {thread_id} is busy, queued message ({len(pending)} pending)")
+        else:
+            pending.append(item)
+            try:
+                self._workers[thread_id] = self.spawn(lambda: self._run(thread_id))
+            except Exception:
+                self._pending.pop(thread_id, None)
+                raise
+        self.stats["submitted"] += 1
+
+    def _next_batch(self, thread_id: str) -> list:
+        pending = self._pending[thread_id]
+        key = self.batch_key(pending[0])
+        size = 1
+        while size < len(pending) and size < self.max_batch and self.batch_key(pending[size]) == key:
+            size += 1
+        batch, self._pending[thread_id] = pending[:size], pending[size:]
+        return batch
+
+    async def _run(self, thread_id: str) -> None:
+        try:
+            while self._pending.get(thread_id):
+                batch = self._next_batch(thread_id)
+                self.stats["batches"] += 1
+                self.stats["coalesced"] += len(batch) - 1
+                try:
+                    await self.handler(thread_id, batch)
+                except Exception as e:
+                    logger.error(f"❌ Handler failed for thread {thread_id}: {e}")
+        finally:
+            # Evict the idle thread so the maps only hold threads with work
+            self._pending.pop(thread_id, None)
+            self._workers.pop(thread_id, None)
+
+    async def join(self) -> None:
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
@@ -0,0 +1,63 @@
+import asyncio
+import unittest
+
+from thread_scheduler import ThreadScheduler
+
+
+class TestThreadScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesces_messages_while_thread_is_busy(self):
+        batches = []
+        release = asyncio.Event()
+
+        async def handler(thread_id, batch):
+            batches.append((thread_id, batch))
+            await release.wait()
+
+        scheduler = ThreadScheduler(handler)
+        scheduler.submit("thread-1", "first")
+        await asyncio.sleep(0)
+        scheduler.submit("thread-1", "second")
+        scheduler.submit("thread-1", "third")
+        release.set()
+        await scheduler.join()
+
+        self.assertEqual(batches, [("thread-1", ["first"]), ("thread-1", ["second", "third"])])
+        self.assertEqual(scheduler.stats["coalesced"], 1)
+        self.assertEqual(scheduler.active_threads, 0)
+
+    async def test_threads_run_concurrently_and_one_at_a_time(self):
+        running = {}
+        overlaps = []
+
+        async def handler(thread_id, batch):
+            if running.get(thread_id):
+                overlaps.append(thread_id)
+            running[thread_id] = True
+            await asyncio.sleep(0.01)
+            running[thread_id] = False
+
+        scheduler = ThreadScheduler(handler)
+        for thread_id in ("a", "b", "a", "b"):
+            scheduler.submit(thread_id, thread_id)
+            self.assertLessEqual(scheduler.active_threads, 2)
+        await scheduler.join()
+
+        self.assertEqual(overlaps, [])
+        self.assertEqual(scheduler.stats["batches"], 2)
+
+    async def test_splits_batches_by_key(self):
+        batches = []
+
+        async def handler(thread_id, batch):
+            batches.append(batch)
+
+        scheduler = ThreadScheduler(handler, batch_key=lambda item: item[0])
+        for item in ("a1", "a2", "b1", "a3"):
+            scheduler.submit("thread-1", item)
+        await scheduler.join()
+
+        self.assertEqual(batches, [["a1", "a2"], ["b1"], ["a3"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from ttl_cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_hit_and_miss_counters(self):
+        cache = TTLCache()
+        cache.set("thread-1", None)
+
+        self.assertIsNone(cache.get("thread-1", "missing"))
+        self.assertEqual(cache.get("thread-2", "missing"), "missing")
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=10)
+        now = time.monotonic()
+        with patch("ttl_cache.time.monotonic", return_value=now):
+            cache.set("long", 1)
+            cache.set("short", 2, ttl=1)
+        with patch("ttl_cache.time.monotonic", return_value=now + 5):
+            self.assertEqual(cache.get("long"), 1)
+            self.assertIsNone(cache.get("short"))
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats["evictions"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()